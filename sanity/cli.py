@@ -31,7 +31,6 @@ from datetime import datetime, timedelta
 
 from prettytable import PrettyTable
 from oslo_config import cfg
-from novaclient import client as no_client
 
 from packages import humanize
 from controller import SanityController, SanityState
@@ -44,6 +43,10 @@ from sanity import host
 from sanity import host_lists
 from sanity import fixtures
 from sanity import os_sdk
+from sanity import watcher
+from sanity import sink
+from sanity import report
+from sanity import reconcile
 
 # Try to disable insecurity warnings
 try:
@@ -187,15 +190,15 @@ class SimpleSanity(object):
             LOG.info("Shutting Down old style Span-Clients")
             self._sanity.wait_for_servers(
                 [server.delete() or server
-                 for server in self._sanity.list_servers(
-                    name_startswith='Span-Client-')])
+                 for server in self._sanity.iter_servers(
+                    name_startswith='Span-Client-', detailed=False)])
         except:
             LOG.error("Failed waiting for old style Span-Clients to shutdown")
         try:
             LOG.info("Shutting Down Servers")
             self._sanity.wait_for_servers(
-                self._sanity.for_servers(
-                    compute.Compute.delete))
+                [compute.Compute.delete(server)
+                 for server in self._sanity.iter_servers(detailed=False)])
         except:
             raise Exception("Failed waiting for servers to shutdown")
         try:
@@ -209,45 +212,42 @@ class SimpleSanity(object):
         self.test_vncconsole(servers)
         self.test_floatingip(servers)
 
-    def test_boot(self, servers=[]):
-        return runner.Runner(
+    def launch_and_test_each_host(self, tests=[]):
+        """Launch on each host and test each server as soon as it's up.
+
+        Unlike launch_on_each_host followed by run_baseline, testing the
+        first servers starts while the rest are still building.
+        """
+        _host = host.Host(self._sanity)
+        servers = self._sanity.for_hosts(_host.boot_server)
+        return self._run_tests(scenarios.get_enabled_tests(tests),
+                               self._sanity.as_completed(servers))
+
+    def _run_tests(self, tests, servers):
+        test_runner = runner.Runner(
             CONF.keystone.auth_url,
             CONF.keystone.tenant_name,
             CONF.keystone.username,
             CONF.keystone.password,
             CONF.keystone.endpoint_type,
             state=self._sanity.get_state(),
-            tests=[scenarios.BootScenario]).run(self._sanity, servers)
+            tests=tests)
+        try:
+            return test_runner.run(self._sanity, servers)
+        finally:
+            test_runner.close()
+
+    def test_boot(self, servers=[]):
+        return self._run_tests([scenarios.BootScenario], servers)
 
     def test_console(self, servers=[]):
-        return runner.Runner(
-            CONF.keystone.auth_url,
-            CONF.keystone.tenant_name,
-            CONF.keystone.username,
-            CONF.keystone.password,
-            CONF.keystone.endpoint_type,
-            state=self._sanity.get_state(),
-            tests=[scenarios.ConsoleScenario]).run(self._sanity, servers)
+        return self._run_tests([scenarios.ConsoleScenario], servers)
 
     def test_vncconsole(self, servers=[]):
-        return runner.Runner(
-            CONF.keystone.auth_url,
-            CONF.keystone.tenant_name,
-            CONF.keystone.username,
-            CONF.keystone.password,
-            CONF.keystone.endpoint_type,
-            state=self._sanity.get_state(),
-            tests=[scenarios.VNCConsoleScenario]).run(self._sanity, servers)
+        return self._run_tests([scenarios.VNCConsoleScenario], servers)
 
     def test_floatingip(self, servers=[]):
-        return runner.Runner(
-            CONF.keystone.auth_url,
-            CONF.keystone.tenant_name,
-            CONF.keystone.username,
-            CONF.keystone.password,
-            CONF.keystone.endpoint_type,
-            state=self._sanity.get_state(),
-            tests=[scenarios.FloatScenario]).run(self._sanity, servers)
+        return self._run_tests([scenarios.FloatScenario], servers)
 
     def print_servers(self, servers=None, with_name=False):
         columns = ['Host ID', 'Server ID']
@@ -260,7 +260,7 @@ class SimpleSanity(object):
 
         servers_by_host = defaultdict(list)
 
-        for server in servers or self.servers():
+        for server in servers or self.servers(incremental=True):
             hostname = getattr(server, 'OS-EXT-SRV-ATTR:host',
                                server.metadata.get('host_id', 'UNKNOWN'))
             servers_by_host[hostname].append(server)
@@ -326,10 +326,37 @@ class SimpleSanity(object):
         pt = self._sanity.report_aggregates(all_hosts)
         print(pt)
 
+    def print_rollup(self):
+        pt = self._sanity.report_rollup()
+        print(pt)
+
     def identity(self, obj):
         return obj
 
 
+def print_report(simple):
+    # print all results
+    print('\nErrors')
+    print('========')
+    simple.print_errors()
+
+    print('\nFailures')
+    print('========')
+    simple.print_failures()
+
+    print('\n\nAggregates')
+    print('=======')
+    simple.print_aggregates()
+
+    print('\n\nAggregate Rollup')
+    print('=======')
+    simple.print_rollup()
+
+    print('\n\nResults')
+    print('=======')
+    simple.print_results()
+
+
 def main_shell(user_ns):
     try:
         from IPython import embed
@@ -379,8 +406,7 @@ class ThreadedBooter(ChildThread):
 
     def list_services(self):
         return {service.host: service
-                for service in self.insanity.state.nova.services.list()
-                if service.binary == 'nova-compute'}
+                for service in self.insanity.list_hosts()}
 
     def __call__(self):
         _host = host.Host(self.insanity)
@@ -444,8 +470,9 @@ class ThreadedLister(ChildThread):
         self.in_queue = in_queue
         self.out_queue = out_queue
         self.insanity = insanity
-        self.servers = {server.metadata['host_id']: server
-                        for server in insanity.list_servers()}
+        self.servers = {
+            server.metadata['host_id']: server
+            for server in insanity.list_servers(incremental=True)}
 
     def __call__(self):
         while not self.in_queue.empty():
@@ -465,6 +492,58 @@ class ThreadedLister(ChildThread):
         LOG.info("Found servers.")
 
 
+class ThreadedWaiter(ChildThread):
+    """Pass servers on in the order they finish booting.
+
+    Servers are handed to the testing threads as soon as they are ACTIVE
+    or ERROR, so a slow server doesn't hold up the ones booted after it.
+    At most max_pending servers are waited on or waiting to be tested.
+    """
+
+    def __init__(self, in_queue, out_queue, insanity, max_pending=None):
+        super(ThreadedWaiter, self).__init__()
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.insanity = insanity
+        self.max_pending = max_pending
+
+    def _server_ready(self, future):
+        server = future.latest
+        if future.exception() is not None:
+            LOG.warning("Timed out waiting for server %s to boot", server.id)
+            watcher.mark_timed_out(server)
+        self.out_queue.put(server)
+
+    def __call__(self):
+        pending = []
+        while not self.is_stopped:
+            pending = [future for future in pending if not future.done()]
+            if self.is_finished and self.in_queue.empty() and not pending:
+                break
+            # Servers that are ready but not yet being tested still count
+            # towards the limit, so booting waits for the testers.
+            if (self.max_pending and
+                    len(pending) + self.out_queue.qsize() >=
+                    self.max_pending):
+                time.sleep(0.1)
+                continue
+
+            try:
+                server = self.in_queue.get_nowait()
+            except Queue.Empty:
+                time.sleep(0.1)
+                continue
+
+            if scenarios.has_booted(server):
+                future = self.insanity.watch_server(server)
+                future.add_done_callback(self._server_ready)
+                pending.append(future)
+            else:
+                self.out_queue.put(server)
+            self.in_queue.task_done()
+        LOG.info("Finished waiting for servers.")
+
+
 class BaseRunner(ChildThread):
     _failed_fixtures = None
 
@@ -500,7 +579,11 @@ class Tester(BaseRunner):
         self._failed_fixtures = self.test_runner.setUpFixtures()
 
     def test_server(self, server):
-        if scenarios.has_booted(server):
+        # Servers that already timed out are tested as they are, the boot
+        # check records them as failed.
+        if (scenarios.has_booted(server) and
+                not watcher.has_timed_out(server) and
+                not watcher.is_settled(server)):
             LOG.info('Waiting for %s to finish booting' % server.id)
             try:
                 self.insanity.wait_for_servers([server])
@@ -556,7 +639,10 @@ class Tester(BaseRunner):
             self.out_queue.put(server)
             self.in_queue.task_done()
 
-        self.test_runner.cleanup()
+        try:
+            self.test_runner.cleanup()
+        finally:
+            self.test_runner.close()
         LOG.info("Finished testing servers.")
 
 
@@ -609,11 +695,12 @@ class Fixturer(BaseRunner):
 
             LOG.info('Waiting for %s to finish booting' % server.id)
             if scenarios.has_booted(server):
-                try:
-                    self.insanity.wait_for_servers([server])
-                    LOG.info('Booted %s' % server.id)
-                except:
-                    LOG.exception("Timed out waiting for server to boot.")
+                if not watcher.is_settled(server):
+                    try:
+                        self.insanity.wait_for_servers([server])
+                        LOG.info('Booted %s' % server.id)
+                    except:
+                        LOG.exception("Timed out waiting for server to boot.")
                 _server = self.nova.servers.get(server)
                 for Fixture in fixtures.get_enabled_fixtures(
                         CONF.action.with_fixture):
@@ -674,6 +761,7 @@ class MainBase(object):
         if hasattr(CONF.action, 'max_servers'):
             server_queue_kw['maxsize'] = CONF.action.max_servers
         servers_queue = Queue.Queue(**server_queue_kw)
+        ready_queue = Queue.Queue()
         completed = Queue.Queue()
 
         controller = \
@@ -685,9 +773,16 @@ class MainBase(object):
         thread.daemon = True
         self.threads.append(thread)
 
+        # Hand servers to the testing threads in the order they finish
+        # booting rather than the order they were booted in.
+        self.waiter = ThreadedWaiter(
+            servers_queue, ready_queue, insanity,
+            max_pending=server_queue_kw.get('maxsize'))
+        self.thread_controllers.append(self.waiter)
+
         test_controllers = []
         for i in range(1, CONF.action.threads + 1)[:len(self.host_list)]:
-            controller = self.Controller(servers_queue, completed, insanity)
+            controller = self.Controller(ready_queue, completed, insanity)
             controller.initialize()
             test_controllers.append(controller)
 
@@ -714,18 +809,36 @@ class MainBase(object):
             thread.start()
 
         self.start_tests = datetime.utcnow()
+        completed_servers = self.wait_for_threads(completed)
+
+        self.pre_clean(**user_ns)
+        if not getattr(CONF.action, 'no_delete', False):
+            self.clean([server for server in completed_servers
+                        if scenarios.has_booted(server)])
+        self.post_clean(**user_ns)
+
+    def wait_for_threads(self, completed):
         completed_servers = []
-        while threading.active_count() > 1:
+        # Wait on our own threads only, background threads such as the
+        # token refresher live for as long as the connection does.
+        while any(thread.is_alive() for thread in self.threads):
             # Check if all the servers are booted, if they are then
-            # tell the testing threads to stop once they finish
+            # tell the waiting thread to stop once every server is
+            # ready and the testing threads to stop once they finish
             # testing.
             all_booted = True
-            for thread in threading.enumerate():
+            all_ready = True
+            for thread in self.threads:
                 if thread.getName().startswith('ThreadedBooter-') \
                    or thread.getName().startswith('ThreadedLister-'):
                     if thread.is_alive():
                         all_booted = False
+                if thread.getName().startswith('ThreadedWaiter-'):
+                    if thread.is_alive():
+                        all_ready = False
             if all_booted:
+                self.waiter.finish()
+            if all_booted and all_ready:
                 for controller in self.thread_controllers:
                     controller.finish()
 
@@ -737,12 +850,9 @@ class MainBase(object):
                     self.print_eta(completed_servers)
             except Queue.Empty:
                 pass
-
-        self.pre_clean(**user_ns)
-        if not getattr(CONF.action, 'no_delete', False):
-            self.clean([server for server in completed_servers
-                        if scenarios.has_booted(server)])
-        self.post_clean(**user_ns)
+        while not completed.empty():
+            completed_servers.append(completed.get_nowait())
+        return completed_servers
 
     def pre_start(self, **kwargs):
         print('Started at: %s' % self.start_time)
@@ -764,8 +874,17 @@ class MainBase(object):
 
     def sig_term(self, signum, frame):
         print("SIGTERM handler.  Shutting Down.")
+        self.close_sink()
         sys.exit()
 
+    def close_sink(self):
+        insanity = self.user_ns['insanity']
+        if insanity.sink is not None:
+            insanity.sink.close()
+            LOG.info('Wrote %s records to %s.', insanity.sink.count,
+                     insanity.sink.filename)
+            insanity.sink = None
+
     def sig_int(self, signum, frame):
         if (datetime.utcnow() - self.sig_inted_at) < timedelta(seconds=3):
             print("Stopping all threads. Shutting down.")
@@ -778,23 +897,20 @@ class MainBase(object):
                   "3 seconds to exit.")
 
     def expand_hosts(self, hosts):
-        valid_hosts = self.user_ns['hosts']()
         if hosts:
+            inventory = self.user_ns['insanity'].host_inventory
             hosts_to_test = []
             # Match qualified and unqualified hostnames, but always return
             # the qualified version.
-            valid_hosts_map = {_host: _host for _host in valid_hosts}
-            valid_hosts_map.update({
-                _host.split('.', 1)[0]: _host for _host in valid_hosts})
             for _host in hosts:
                 for canonical_host in set(host_lists.expand(_host)):
-                    host_with_fqdn = valid_hosts_map.get(canonical_host)
-                    if host_with_fqdn:
-                        hosts_to_test.append(host_with_fqdn)
+                    service = inventory.get(canonical_host)
+                    if service:
+                        hosts_to_test.append(service.host)
                     else:
                         hosts_to_test.append(canonical_host)
         else:
-            hosts_to_test = valid_hosts
+            hosts_to_test = self.user_ns['hosts']()
         return hosts_to_test
 
     def _eta(self, completed_hosts, remaining_hosts):
@@ -828,7 +944,17 @@ class MainBase(object):
 class MainTest(MainBase):
     Controller = Tester
 
-    def pre_start(self, stop, **kwargs):
+    def pre_start(self, stop, insanity, **kwargs):
+        insanity.state.add_security_group_rules(
+            scenarios.get_security_group_rules(CONF.action.test))
+        if CONF.action.output_stream:
+            insanity.sink = sink.ResultSink(
+                CONF.action.output_stream,
+                fsync_interval=CONF.action.fsync_interval)
+            try:
+                insanity.sink.write_snapshot(insanity.host_snapshot())
+            except Exception:
+                LOG.exception("Failed to record the hosts and aggregates")
         if CONF.action.no_boot:
             CONF.action.no_initial_clean = True
             CONF.action.no_delete = True
@@ -847,36 +973,20 @@ class MainTest(MainBase):
         if CONF.action.output_json:
             self.dump_json_report(CONF.action.output_json)
 
-    def print_all(self):
-        print_results = self.user_ns['print_results']
-        print_failures = self.user_ns['print_failures']
-        print_errors = self.user_ns['print_errors']
-        print_aggregates = self.user_ns['print_aggregates']
-
-        # print all results
-        print('\nErrors')
-        print('========')
-        print_errors()
-
-        print('\nFailures')
-        print('========')
-        print_failures()
-
-        print('\n\nAggregates')
-        print('=======')
-        print_aggregates()
+    def post_clean(self, **kwargs):
+        self.close_sink()
+        super(MainTest, self).post_clean(**kwargs)
 
-        print('\n\nResults')
-        print('=======')
-        print_results()
+    def print_all(self):
+        print_report(self.user_ns['simple'])
 
     def dump_json_report(self, filename):
         insanity = self.user_ns['insanity']
 
         results = {}
-        for test in insanity._test_results:
+        for test, test_results in insanity.results.snapshot().items():
             results[test] = []
-            for key, result in insanity._test_results[test].items():
+            for key, result in test_results.items():
                 host, server = key
                 results[test].append((host, server, result.to_dict()))
 
@@ -929,7 +1039,7 @@ class MainBoot(MainBase):
                           'Task State', 'VM State', 'Created',
                           'Updated', 'IP Addresses'])
         pt.align = 'l'
-        for server in insanity.list_servers():
+        for server in insanity.iter_servers():
             hostname = getattr(server, 'OS-EXT-SRV-ATTR:host',
                                server.metadata.get('host_id', 'UNKNOWN'))
             created = humanize.naturaltime(
@@ -959,7 +1069,7 @@ class MainBoot(MainBase):
         insanity = self.user_ns['insanity']
 
         results = {}
-        for server in insanity.list_servers():
+        for server in insanity.iter_servers():
             hostname = getattr(server, 'OS-EXT-SRV-ATTR:host',
                                server.metadata.get('host_id', 'UNKNOWN'))
             ip_addresses = ', '.join([port['addr']
@@ -975,7 +1085,7 @@ class MainBoot(MainBase):
         insanity = self.user_ns['insanity']
 
         ips = []
-        for server in insanity.list_servers():
+        for server in insanity.iter_servers():
             print(server.addresses.values())
             ip_addresses = ''.join([port['addr']
                                     for address in server.addresses.values()
@@ -1001,6 +1111,24 @@ def main_stop(user_ns):
             pass
 
 
+def main_reconcile(user_ns):
+    reconciler = reconcile.Reconciler(
+        user_ns['state'], user_ns['insanity'],
+        max_workers=CONF.action.workers, rate=CONF.action.rate)
+    orphans = reconciler.find()
+    print_heading("Leaked resources")
+    print(reconciler.report(orphans))
+    if CONF.action.dry_run:
+        return
+    failed = defaultdict(list)
+    for orphan in reconciler.delete(orphans):
+        failed[orphan.kind].append(orphan)
+    if failed:
+        print_heading("Failed to delete")
+        print(reconciler.report(failed))
+        sys.exit(1)
+
+
 def main_host_list(user_ns):
     hosts = user_ns['hosts']
     for _host in host_lists.compress(hosts()):
@@ -1011,6 +1139,32 @@ def main_exec(user_ns):
     execfile(CONF.action.file, globals(), user_ns)
 
 
+def main_fold_results(user_ns):
+    results = sink.fold_results(sink.read_results(CONF.action.stream))
+    if CONF.action.output_json:
+        with open(CONF.action.output_json, 'w') as outfile:
+            json.dump(results, outfile)
+    else:
+        json.dump(results, sys.stdout)
+
+
+def main_report(user_ns):
+    stored = report.StoredResults.load(CONF.action.results,
+                                       CONF.action.snapshot)
+    hosts = None
+    if CONF.action.host:
+        hosts = [canonical_host for _host in CONF.action.host
+                 for canonical_host in host_lists.expand(_host)]
+    if hosts or CONF.action.test:
+        stored = stored.filter(hosts=hosts, tests=CONF.action.test)
+    print_report(SimpleSanity(stored))
+
+
+# Commands that work on local files and don't need a cloud connection.
+main_fold_results.offline = True
+main_report.offline = True
+
+
 def add_parsers(subparsers):
     shell = subparsers.add_parser(
         'shell', help='Interactive sanity shell.')
@@ -1056,6 +1210,14 @@ def add_parsers(subparsers):
     test.add_argument(
         '--output-json', action='store',
         help="The location of the file to print the JSON report to.")
+    test.add_argument(
+        '--output-stream', action='store',
+        help="A file to append each result to as a JSON line as soon as "
+        "it is recorded, compressed if it ends in .gz.")
+    test.add_argument(
+        '--fsync-interval', action='store', default=5, type=float,
+        help="The maximum seconds between syncing the result stream "
+        "to disk.")
     test.add_argument(
         '--write-retry', action='store_true',
         help="The the failed nodes to a file for re-running.")
@@ -1072,6 +1234,20 @@ def add_parsers(subparsers):
         'stop', help='Stop all running sanity hosts and cleanup.')
     stop.set_defaults(func=main_stop)
 
+    reconcile_parser = subparsers.add_parser(
+        'reconcile',
+        help='Find and delete resources left behind by interrupted runs.')
+    reconcile_parser.add_argument(
+        '--dry-run', action='store_true',
+        help="Only list what would be deleted.")
+    reconcile_parser.add_argument(
+        '--workers', action='store', default=10, type=int,
+        help="How many resources to delete at the same time.")
+    reconcile_parser.add_argument(
+        '--rate', action='store', default=10, type=float,
+        help="The maximum number of deletes per second.")
+    reconcile_parser.set_defaults(func=main_reconcile)
+
     script = subparsers.add_parser(
         'script', help='Run a script.')
     script.add_argument(
@@ -1104,6 +1280,37 @@ def add_parsers(subparsers):
         help="The location of the file to print the floating IP report to.")
     boot.set_defaults(func=MainBoot())
 
+    fold = subparsers.add_parser(
+        'fold-results',
+        help='Turn a result stream into a JSON report.')
+    fold.add_argument(
+        'stream',
+        help="The result stream written with --output-stream.")
+    fold.add_argument(
+        '--output-json', action='store',
+        help="The location of the file to print the JSON report to, "
+        "defaults to stdout.")
+    fold.set_defaults(func=main_fold_results)
+
+    report_parser = subparsers.add_parser(
+        'report',
+        help='Print the reports from saved results.')
+    report_parser.add_argument(
+        'results',
+        help="A result stream written with --output-stream or a JSON "
+        "report written with --output-json.")
+    report_parser.add_argument(
+        '--snapshot',
+        help="A result stream to read the hosts and aggregates from, "
+        "if they aren't in the results.")
+    report_parser.add_argument(
+        '-w', '--host', action='append', default=[],
+        help="Only report on these hosts.")
+    report_parser.add_argument(
+        '--test', action='append', default=[],
+        help="Only report on these tests.")
+    report_parser.set_defaults(func=main_report)
+
 
 def main():
     logging.getLogger('sanity').setLevel(logging.INFO)
@@ -1132,6 +1339,9 @@ def main1():
         file_log.setFormatter(logging.Formatter(LOG_FORMAT))
         logging.root.addHandler(file_log)
 
+    if getattr(CONF.action.func, 'offline', False):
+        return CONF.action.func({})
+
     if not CONF.keystone.auth_url:
         LOG.error('You must provide a keystone auth'
                   ' url via env[OS_AUTH_URL]')
@@ -1155,13 +1365,16 @@ def main1():
     tenant = user_ns['OS_TENANT_NAME'] = CONF.keystone.tenant_name
     username = user_ns['OS_USERNAME'] = CONF.keystone.username
     endpoint_type = user_ns['OS_ENDPOINT_TYPE'] = CONF.keystone.endpoint_type
-    clientmanager = user_ns['clientmanager'] = os_sdk.create_connection(
-        auth_url, tenant, username, password, endpoint_type=endpoint_type)
-    keystone = user_ns['keystone'] = clientmanager.identity
-    nova = user_ns['nova'] = no_client.Client(
-        '2', session=clientmanager.session)
-    neutron = user_ns['neutron'] = clientmanager.network
-    glance = user_ns['glance'] = clientmanager.image
+    # Held for the whole run, the test runners share this connection.
+    clients = os_sdk.connections.acquire(
+        auth_url, tenant, username, password, endpoint_type=endpoint_type,
+        pool_size=os_sdk.default_pool_size(
+            getattr(CONF.action, 'threads', 0)))
+    user_ns['clientmanager'] = clients.connection
+    keystone = user_ns['keystone'] = clients.keystone
+    nova = user_ns['nova'] = clients.nova
+    neutron = user_ns['neutron'] = clients.neutron
+    glance = user_ns['glance'] = clients.glance
     state = user_ns['state'] = SanityState(
         keystone, nova, glance, neutron,
         # Trim out the OSLO elements
@@ -1191,4 +1404,10 @@ def main1():
     for k in dir(sanity):
         if k.startswith('wait_'):
             user_ns[k] = getattr(sanity, k)
+    user_ns['as_completed'] = sanity.as_completed
     CONF.action.func(user_ns)
+    LOG.info("HTTP connection pools: %s", clients.session.pool_stats)
+    if clients.session.coalescer is not None:
+        LOG.info("Coalesced GETs: %s", clients.session.coalescer)
+    if clients.session.response_cache is not None:
+        LOG.info("Response cache: %s", clients.session.response_cache)
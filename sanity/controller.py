@@ -16,25 +16,31 @@
 
 from __future__ import print_function
 
+import json
 import operator
+import os
 from os import path
 import re
 import time
 import random
 import string
 import logging
-from collections import defaultdict
+import threading
+from functools import partial
+from datetime import datetime, timedelta
 
+from six.moves import queue
 from passlib.hash import sha512_crypt
-from prettytable import PrettyTable
 from novaclient import exceptions as n_exceptions
 from openstack import exceptions as os_exceptions
 from oslo_config import cfg
 
 from sanity.host import gethostid
-from sanity.util import listify
-from sanity.results import Success, Failure, Error
-from sanity import scenarios
+from sanity.util import listify, background, run_graph, run_parallel
+from sanity.results import ResultStore
+from sanity.watcher import ServerWatcher, ServerTimeout
+from sanity import os_sdk
+from sanity import report
 
 
 LOG = logging.getLogger(__name__)
@@ -88,12 +94,67 @@ opts = [
                 help="Don't test using floating networks."),
     cfg.IntOpt('build-timeout', default=60,
                help="Maximum time to wait for a server to become ACTIVE."),
+    cfg.FloatOpt('poll-interval', default=1,
+                 help="Initial seconds between polls of the server list "
+                 "while waiting for servers."),
+    cfg.FloatOpt('poll-max-interval', default=10,
+                 help="Maximum seconds between polls of the server list "
+                 "while none of the servers being waited for change."),
+    cfg.IntOpt('host-cache-ttl', default=300,
+               help="Seconds to cache the list of compute hosts for."),
+    cfg.IntOpt('page-size', default=None,
+               help="The number of servers to request per page when "
+               "listing servers, defaults to the API's limit."),
+    cfg.IntOpt('cleanup-workers', default=10, min=1,
+               help="The number of resources to delete at the same time "
+               "when cleaning up."),
+    cfg.StrOpt('state-cache', default=None,
+               help="A file to remember the flavor, image, networks, "
+               "router and security group in between runs."),
+    cfg.BoolOpt('compact-results', default=False,
+                help="Keep test results in a compact table, for runs "
+                "over a very large number of hosts."),
+    cfg.IntOpt('compact-max-output', default=0, min=0,
+               help="With --compact-results, keep only the last this many "
+               "characters of long result details such as console output. "
+               "0 keeps everything."),
 ]
 
 CONF.register_opts(opts)
 CONF.register_cli_opts(opts)
 
 
+# The rules every sanity security group has, ping and SSH.  Scenarios can
+# ask for more with their security_group_rules attribute.
+SECURITY_GROUP_RULES = [
+    {'direction': 'ingress',
+     'protocol': 'icmp'},
+    {'direction': 'ingress',
+     'port_range_min': 22,
+     'port_range_max': 22,
+     'protocol': 'tcp',
+     'ethertype': 'IPv4',
+     'remote_ip_prefix': '0.0.0.0/0'},
+]
+
+
+def security_group_rule_key(rule):
+    """The parts of a rule Neutron uses to tell if two rules are the same.
+    """
+    if hasattr(rule, 'to_dict'):
+        rule = rule.to_dict()
+    protocol = rule.get('protocol')
+    port_range_min = rule.get('port_range_min')
+    port_range_max = rule.get('port_range_max')
+    return (rule.get('direction'),
+            rule.get('ethertype') or 'IPv4',
+            protocol.lower() if protocol else None,
+            int(port_range_min) if port_range_min is not None else None,
+            int(port_range_max) if port_range_max is not None else None,
+            rule.get('remote_ip_prefix'),
+            rule.get('remote_group_id'))
+
+
 class ImageNotFound(Exception):
     pass
 
@@ -103,32 +164,255 @@ def random_string(length):
                     for _ in range(length)])
 
 
-def list_servers(client, all_tenants=False, limit=None, **kwargs):
-    servers = []
-    marker = None
+def name_regex(prefix):
+    """Build a Nova name filter matching names starting with prefix."""
+    return '^' + re.sub(r'([.^$*+?()\[\]{}|\\])', r'\\\1', prefix)
+
+
+def iter_servers(client, all_tenants=False, limit=None, page_size=None,
+                 prefetch=False, detailed=True, **kwargs):
+    """Iterate over the servers one page at a time.
+
+    With prefetch, once the caller has moved past the first server of a
+    page the next page is fetched in the background while the rest are
+    consumed.  It's only worth it for callers that read every page.  At
+    most limit servers are returned.  Any other keyword arguments are
+    passed to Nova as search options.
+    """
     opts = {}
-    if limit:
-        opts['limit'] = limit
+    if page_size:
+        opts['limit'] = page_size
     if all_tenants:
         opts["all_tenants"] = True
     opts.update(kwargs)
 
-    while True:
+    def fetch(marker=None):
+        page_opts = dict(opts)
         if marker:
-            opts["marker"] = marker
+            page_opts["marker"] = marker
+        return client.servers.list(detailed=detailed, search_opts=page_opts)
 
-        result = client.servers.list(search_opts=opts)
+    count = 0
+    page = fetch()
+    while page:
+        if limit:
+            page = page[:limit - count]
+        count += len(page)
 
-        if not result:
-            break
+        next_page = None
+        if not (limit and count >= limit):
+            next_page = partial(fetch, page[-1].id)
 
-        servers.extend(result)
+        for index, server in enumerate(page):
+            yield server
+            if index == 0 and prefetch and next_page is not None:
+                next_page = background(fetch, page[-1].id)
+
+        if next_page is None:
+            break
+        page = next_page()
 
-        if len(servers) > limit:
-            return servers
 
-        marker = servers[-1].id
-    return servers
+def list_servers(client, all_tenants=False, limit=None, **kwargs):
+    kwargs.setdefault('prefetch', True)
+    return list(iter_servers(client, all_tenants=all_tenants,
+                             limit=limit, **kwargs))
+
+
+class ServerIndex(object):
+    """An in-memory copy of the server list that is updated incrementally.
+
+    The first refresh lists every server, after that Nova is only asked
+    for the servers that changed since the previous refresh and those
+    changes are merged into the index, keyed by server id.
+    """
+    timestamp_format = "%Y-%m-%dT%H:%M:%SZ"
+
+    # Ask for a little more than strictly needed so that servers updated
+    # within the same second as the last poll aren't missed.
+    overlap = timedelta(seconds=2)
+
+    deleted_states = ('DELETED', 'SOFT_DELETED')
+
+    def __init__(self, client, **search_opts):
+        self._client = client
+        self._search_opts = search_opts
+        self._servers = {}
+        self._changes_since = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            opts = dict(self._search_opts)
+            if self._changes_since:
+                opts['changes-since'] = self._changes_since
+            else:
+                self._servers = {}
+
+            last_updated = None
+            for server in iter_servers(self._client, prefetch=True, **opts):
+                if server.status in self.deleted_states:
+                    self._servers.pop(server.id, None)
+                else:
+                    self._servers[server.id] = server
+                # Use Nova's idea of the time so clock skew doesn't matter
+                updated = datetime.strptime(server.updated,
+                                            self.timestamp_format)
+                if last_updated is None or updated > last_updated:
+                    last_updated = updated
+
+            if last_updated is not None:
+                self._changes_since = (last_updated - self.overlap).strftime(
+                    self.timestamp_format)
+            return self.servers()
+
+    def servers(self):
+        return sorted(self._servers.values(),
+                      key=operator.attrgetter('created', 'id'),
+                      reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._servers = {}
+            self._changes_since = None
+
+
+class HostInventory(object):
+    """The nova-compute services, listed at most once every ttl seconds.
+
+    Services can be looked up by their hostname, their short hostname or
+    their service id.
+    """
+
+    def __init__(self, client, ttl=300):
+        self._client = client
+        self.ttl = ttl
+        self._services = []
+        self._index = {}
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        services = []
+        for service in self._client.services.list(binary='nova-compute'):
+            if service.binary != 'nova-compute':
+                continue
+            services.append(service)
+        services = sorted(services, key=operator.attrgetter('host'))
+
+        index = {}
+        for service in services:
+            index[service.host.split('.', 1)[0]] = service
+        for service in services:
+            index[str(service.id)] = service
+            index[service.host] = service
+
+        self._services = services
+        self._index = index
+        self._expires = time.time() + self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self._expires = 0
+        os_sdk.invalidate_cached(self._client, 'services')
+
+    def _maybe_refresh(self):
+        with self._lock:
+            if time.time() >= self._expires:
+                self.refresh()
+
+    def services(self):
+        self._maybe_refresh()
+        return list(self._services)
+
+    def get(self, host):
+        """Look up a service by hostname, short hostname or id."""
+        self._maybe_refresh()
+        return self._index.get(str(gethostid(host)))
+
+    def state(self, host):
+        service = self.get(host)
+        return service.state if service else None
+
+    def status(self, host):
+        service = self.get(host)
+        return service.status if service else None
+
+
+class AggregateMap(object):
+    """The host aggregates, listed once and kept until invalidated.
+
+    Aggregate membership rarely changes during a run, so it isn't worth
+    listing every aggregate each time a report is printed.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._aggregates = None
+        self._by_host = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        aggregates = dict((agg.name, sorted(agg.hosts))
+                          for agg in self._client.aggregates.list())
+        self._aggregates = aggregates
+        self._by_host = report.host_aggregates(aggregates)
+
+    def invalidate(self):
+        with self._lock:
+            self._aggregates = None
+        os_sdk.invalidate_cached(self._client, 'aggregates')
+
+    def _maybe_refresh(self):
+        with self._lock:
+            if self._aggregates is None:
+                self.refresh()
+
+    def aggregates(self):
+        """Return {aggregate: [host, ...]}."""
+        self._maybe_refresh()
+        return dict(self._aggregates)
+
+    def by_host(self):
+        """Return {host: [aggregate, ...]}."""
+        self._maybe_refresh()
+        return self._by_host
+
+    def for_host(self, host):
+        return list(self.by_host().get(host, []))
+
+
+class StateCache(object):
+    """A JSON file of resource ids, one entry per cloud and project.
+
+    Each resource is stored with the configuration it was found with,
+    {name: {'id': id, 'config': config}}, so that changing the
+    configuration ignores the cached id.
+    """
+
+    def __init__(self, filename):
+        self.filename = path.abspath(path.expanduser(filename))
+
+    def _read(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            LOG.warning("Ignoring unreadable state cache %s", self.filename)
+            return {}
+
+    def load(self, key):
+        return self._read().get(key, {})
+
+    def save(self, key, resources):
+        cache = self._read()
+        cache[key] = resources
+        tmp_filename = '%s.%s.tmp' % (self.filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
 
 
 class SanityState(object):
@@ -172,6 +456,7 @@ class SanityState(object):
         self.nova = nova
         self.glance = glance
         self.neutron = neutron
+        self.security_group_rules = list(SECURITY_GROUP_RULES)
 
         self._image_name_re = CONF.image_name_re
 
@@ -180,36 +465,161 @@ class SanityState(object):
                 setattr(self, '_' + key, value)
 
     def setUp(self):
-        self.flavor
-        self.availability_zone
-        self.image
-        self.keypair
+        """Find or create everything the servers need.
 
-        self.security_group
-        self.create_security_group_rules()
-
-        self.external_net
+        Lookups that don't depend on each other run at the same time, so
+        setting up takes as long as the longest chain of lookups.
+        """
+        configs = self._cache_configs()
+        cached = self._load_cache()
+
+        def resolve(name):
+            def fn():
+                if name in configs:
+                    self._use_cached(name, configs[name], cached.get(name))
+                return getattr(self, name)
+            return fn
+
+        tasks = {
+            'flavor': (resolve('flavor'), []),
+            'availability_zone': (resolve('availability_zone'), []),
+            'image': (resolve('image'), []),
+            'keypair': (resolve('keypair'), []),
+            'security_group': (resolve('security_group'), []),
+            'security_group_rules': (self.create_security_group_rules,
+                                     ['security_group']),
+            'external_net': (resolve('external_net'), []),
+        }
         if CONF.floating:
-            self.router
-        self.network
+            tasks['router'] = (resolve('router'), [])
+            # A new network's subnet is attached to the router
+            tasks['network'] = (resolve('network'), ['router'])
+            tasks['router_ports'] = (self.check_router_ports,
+                                     ['router', 'network', 'external_net'])
+        else:
+            tasks['network'] = (resolve('network'), ['external_net'])
+        run_graph(tasks)
+        self._save_cache(configs)
+
+    #
+    # State cache
+    #
+    def _cache_configs(self):
+        """The configuration each cacheable resource is found with."""
+        configs = {
+            'flavor': list(self._flavors),
+            'image': self._image_name_re,
+            'external_net': [self._external_net_re, CONF.floating],
+            'security_group': self._security_group_name,
+        }
         if CONF.floating:
-            self.check_router_ports()
+            configs['router'] = self._router_name
+            configs['network'] = self._network_name
+        return configs
+
+    def _cache_key(self):
+        auth_url = getattr(self.keystone.session.auth, 'auth_url', None)
+        return '%s %s' % (auth_url, self.keystone.session.get_project_id())
+
+    def _load_cache(self):
+        if not CONF.state_cache:
+            return {}
+        try:
+            return StateCache(CONF.state_cache).load(self._cache_key())
+        except Exception:
+            LOG.warning("Failed to read the state cache", exc_info=True)
+            return {}
+
+    def _save_cache(self, configs):
+        if not CONF.state_cache:
+            return
+        resources = {}
+        for name, config in configs.items():
+            resource = getattr(self, '_SanityState__' + name)
+            resource_id = resource if name == 'flavor' else resource.id
+            resources[name] = {'id': resource_id, 'config': config}
+        try:
+            StateCache(CONF.state_cache).save(self._cache_key(), resources)
+        except Exception:
+            LOG.warning("Failed to write the state cache", exc_info=True)
+
+    def _use_cached(self, name, config, entry):
+        """Check a cached resource still exists and matches, and use it."""
+        if not entry or entry.get('config') != config:
+            return
+        try:
+            resource = getattr(self, '_check_cached_' + name)(entry['id'])
+        except Exception as e:
+            LOG.info("Cached %s %s is stale: %s", name, entry['id'], e)
+            return
+        if not resource:
+            LOG.info("Cached %s %s no longer matches", name, entry['id'])
+            return
+        LOG.info("Using cached %s %s", name, entry['id'])
+        setattr(self, '_SanityState__' + name, resource)
+
+    def _check_cached_flavor(self, flavor_id):
+        flavor = self.nova.flavors.get(flavor_id)
+        if flavor.id in self._flavors or flavor.name in self._flavors:
+            return flavor.id
+
+    def _check_cached_image(self, image_id):
+        image = self.glance.get_image(image_id)
+        if (image.status.upper() == 'ACTIVE' and
+                re.match(self._image_name_re, image.name)):
+            return image
+
+    def _check_cached_external_net(self, network_id):
+        network = self.neutron.get_network(network_id)
+        if re.match(self._external_net_re, network['name']):
+            return network
+
+    def _check_cached_security_group(self, group_id):
+        group = self.neutron.get_security_group(group_id)
+        if re.match(self._security_group_name.format('.*'), group['name']):
+            return group
+
+    def _check_cached_router(self, router_id):
+        router = self.neutron.get_router(router_id)
+        if router['name'] == self._router_name:
+            return router
+
+    def _check_cached_network(self, network_id):
+        network = self.neutron.get_network(network_id)
+        if network['name'] == self._network_name:
+            return network
 
     def tearDown(self):
-        LOG.info("Deleting Keypair")
-        self.clean_keypair()
+        """Delete everything setUp created.
 
+        Deletions that don't depend on each other run at the same time.
+        The router interface is removed and the stale ports deleted by
+        clean_subnet, so the router, network and security group wait for
+        it.
+        """
+        def step(message, fn):
+            def run():
+                LOG.info(message)
+                fn()
+            return run
+
+        tasks = {
+            'keypair': (step("Deleting Keypair", self.clean_keypair), []),
+            'security_group': (self.clean_security_group, []),
+        }
         if CONF.floating:
-            LOG.info("Deleting Subnet")
-            self.clean_subnet()
-            LOG.info("Deleting Router")
-            self.clean_router()
-            LOG.info("Deleting Network")
-            self.clean_network()
-            LOG.info("Deleting Unused floating IPs")
-            self.clean_floatingip()
-
-        self.clean_security_group()
+            tasks.update({
+                'subnet': (step("Deleting Subnet", self.clean_subnet), []),
+                'router': (step("Deleting Router", self.clean_router),
+                           ['subnet']),
+                'network': (step("Deleting Network", self.clean_network),
+                            ['subnet']),
+                'floatingip': (step("Deleting Unused floating IPs",
+                                    self.clean_floatingip), []),
+            })
+            tasks['security_group'] = (self.clean_security_group,
+                                       ['subnet'])
+        run_graph(tasks, max_workers=CONF.cleanup_workers)
 
     #
     # Flavor
@@ -221,8 +631,9 @@ class SanityState(object):
         self.__flavor = self.__flavor.id
 
     def _get_flavor(self, *name_or_ids):
+        flavors = list(self.nova.flavors.list())
         for name_or_id in name_or_ids:
-            for flavor in self.nova.flavors.list():
+            for flavor in flavors:
                 if flavor.id == name_or_id:
                     return flavor
                 if flavor.name == name_or_id:
@@ -268,15 +679,15 @@ class SanityState(object):
         self._image_name_re = name_re
 
     def _get_image(self, name_re):
-        for image in sorted(
-                self.glance.images(
-                    visibility='public',
-                    status='ACTIVE'),
-                key=operator.attrgetter('name'),
-                reverse=True):
-            if re.match(name_re, image.name):
-                return image
-        raise ImageNotFound("Can't find valid image to use.")
+        # The matching image with the highest name, usually the newest
+        # release.
+        name_re = re.compile(name_re)
+        images = [image for image in self.glance.images(visibility='public',
+                                                        status='ACTIVE')
+                  if name_re.match(image.name)]
+        if not images:
+            raise ImageNotFound("Can't find valid image to use.")
+        return max(images, key=operator.attrgetter('name'))
 
     @property
     def image(self):
@@ -366,30 +777,39 @@ class SanityState(object):
         group = self.neutron.create_security_group(name=name)
         return self.neutron.get_security_group(group['id'])
 
-    def create_security_group_rules(self):
-        # Ping
-        try:
-            self.neutron.create_security_group_rule(
-                **{'direction': 'ingress',
-                   'security_group_id': self.security_group['id'],
-                   'protocol': 'icmp'})
-        except os_exceptions.HttpException as e:
-            if e.message.lower() != 'conflict':
-                raise
+    def add_security_group_rules(self, rules):
+        """Add rules the security group needs, before setUp is called."""
+        keys = set(security_group_rule_key(rule)
+                   for rule in self.security_group_rules)
+        for rule in rules:
+            if security_group_rule_key(rule) not in keys:
+                keys.add(security_group_rule_key(rule))
+                self.security_group_rules.append(dict(rule))
+
+    def missing_security_group_rules(self):
+        """The rules the security group doesn't have yet."""
+        existing = set(
+            security_group_rule_key(rule)
+            for rule in self.neutron.security_group_rules(
+                security_group_id=self.security_group['id']))
+        return [rule for rule in self.security_group_rules
+                if security_group_rule_key(rule) not in existing]
 
-        # SSH
-        try:
-            self.neutron.create_security_group_rule(
-                **{'direction': 'ingress',
-                   'security_group_id': self.security_group['id'],
-                   'port_range_min': 22,
-                   'port_range_max': 22,
-                   'protocol': 'tcp',
-                   'ethertype': 'IPv4',
-                   'remote_ip_prefix': '0.0.0.0/0'})
-        except os_exceptions.HttpException as e:
-            if e.message.lower() != 'conflict':
-                raise
+    def create_security_group_rules(self):
+        def create(rule):
+            rule = dict(rule, security_group_id=self.security_group['id'])
+            try:
+                self.neutron.create_security_group_rule(**rule)
+            except os_exceptions.HttpException as e:
+                # Another run may have just added it
+                if e.message.lower() != 'conflict':
+                    raise
+
+        missing = self.missing_security_group_rules()
+        if missing:
+            LOG.info("Adding %s rules to Security Group %s",
+                     len(missing), self.security_group['id'])
+        run_parallel(create, missing)
 
     def _get_security_group(self, name):
         groups = self.neutron.security_groups(
@@ -602,11 +1022,14 @@ class SanityState(object):
         except os_exceptions.HttpException as e:
             if e.message.lower() == 'conflict':
                 LOG.info("Stale ports found.")
-                for port in self.neutron.ports(
-                        tenant_id=self.keystone.session.get_project_id(),
-                        network_id=subnet['network_id']):
+
+                def delete_port(port):
                     LOG.info("Delete port %s", port['id'])
                     self.neutron.delete_port(port['id'])
+                run_parallel(delete_port, self.neutron.ports(
+                    tenant_id=self.keystone.session.get_project_id(),
+                    network_id=subnet['network_id']),
+                    max_workers=CONF.cleanup_workers)
                 self.neutron.delete_subnet(subnet['id'])
 
     #
@@ -615,10 +1038,13 @@ class SanityState(object):
     def clean_floatingip(self):
         floatingips = self.neutron.ips(
             tenant_id=self.keystone.session.get_project_id())
-        for ip in floatingips:
-            if ip['port_id'] is None:
-                LOG.info('Deleting floating IP %s', ip['id'])
-                self.neutron.delete_ip(ip['id'])
+
+        def delete_ip(ip):
+            LOG.info('Deleting floating IP %s', ip['id'])
+            self.neutron.delete_ip(ip['id'])
+        run_parallel(delete_ip, [ip for ip in floatingips
+                                 if ip['port_id'] is None],
+                     max_workers=CONF.cleanup_workers)
 
     def to_dict(self):
         state = {
@@ -641,10 +1067,25 @@ class SanityState(object):
 
 class SanityController(object):
     _services = None
-    _test_results = {}
+    name_prefix = 'Sanity-'
 
     def __init__(self, state):
         self.state = state
+        self.results = ResultStore(
+            compact=CONF.compact_results,
+            max_extra_length=CONF.compact_max_output)
+        # Optional ResultSink that results are streamed to as they're added
+        self.sink = None
+        self.host_inventory = HostInventory(state.nova,
+                                            ttl=CONF.host_cache_ttl)
+        self.aggregate_map = AggregateMap(state.nova)
+        self.server_index = ServerIndex(state.nova,
+                                        page_size=CONF.page_size,
+                                        name=name_regex(self.name_prefix))
+        self.watcher = ServerWatcher(
+            lambda: self.list_servers(incremental=True),
+            min_interval=CONF.poll_interval,
+            max_interval=CONF.poll_max_interval)
 
     def setUp(self):
         self.state.setUp()
@@ -652,15 +1093,22 @@ class SanityController(object):
     def tearDown(self):
         self.state.tearDown()
 
+    @property
+    def _test_results(self):
+        return self.results.snapshot()
+
     def add_test_result(self, test_name, host, server, result):
-        if test_name not in self._test_results:
-            self._test_results[test_name] = {}
-        self._test_results[test_name][(host, server)] = result
+        self.results.add(test_name, host, server, result)
+        # The sink can be closed and dropped by another thread at any time
+        sink = self.sink
+        if sink is not None:
+            try:
+                sink.write(test_name, host, server, result)
+            except Exception:
+                LOG.exception("Failed to write result to %s", sink.filename)
 
     def get_test_result(self, test_name, host, server):
-        if test_name not in self._test_results:
-            self._test_results[test_name] = {}
-        return self._test_results[test_name].get((host, server))
+        return self.results.get(test_name, host, server)
 
     def get_state(self):
         return self.state.to_dict()
@@ -669,12 +1117,7 @@ class SanityController(object):
     # Hosts
     #
     def list_hosts(self):
-        services = []
-        for service in self.state.nova.services.list():
-            if service.binary != 'nova-compute':
-                continue
-            services.append(service)
-        self._services = sorted(services, key=operator.attrgetter('host'))
+        self._services = self.host_inventory.services()
         return self._services
 
     @listify
@@ -688,7 +1131,7 @@ class SanityController(object):
 
         """
         hosts = {gethostid(host): host for host in self.list_hosts()}
-        for server in self.list_servers():
+        for server in self.iter_servers():
             host_id = server.metadata['host_id']
             if host_id in hosts:
                 del hosts[host_id]
@@ -702,7 +1145,7 @@ class SanityController(object):
 
         """
         hosts = {gethostid(host): host for host in self.list_hosts()}
-        for server in self.list_servers():
+        for server in self.iter_servers():
             host_id = server.metadata['host_id']
             if host_id not in hosts:
                 del hosts[host_id]
@@ -717,7 +1160,7 @@ class SanityController(object):
         password = random_string(8)
         hashed_password = sha512_crypt.encrypt(password)
         return self.state.nova.servers.create(
-            name="Sanity-%s" % gethostid(host).split('.', 1)[0],
+            name=self.name_prefix + gethostid(host).split('.', 1)[0],
             image=self.state.image.id,
             flavor=self.state.flavor,
             key_name=self.state.keypair.name,
@@ -730,167 +1173,176 @@ class SanityController(object):
                                         gethostid(host)]),
             userdata=USER_DATA % hashed_password)
 
-    @listify
-    def list_servers(self, name_startswith='Sanity-', **kwargs):
-        for server in list_servers(self.state.nova, **kwargs):
+    def iter_servers(self, name_startswith=name_prefix, incremental=False,
+                     status=None, host=None, tags=None, detailed=True,
+                     prefetch=False, **kwargs):
+        """Iterate over the servers matching the filters.
+
+        The name prefix, status, host and tags filters are passed on to
+        Nova so that unrelated servers are never downloaded, Nova ignores
+        the host and tags filters for users that aren't allowed to use
+        them.  Set detailed to False when only the server ids and names
+        are needed, and prefetch to fetch the next page in the background
+        when every page will be read.
+
+        An incremental listing only fetches the servers that changed since
+        the last incremental listing from the server index, it's only used
+        for unfiltered, detailed listings of sanity servers.
+        """
+        if (incremental and not kwargs and detailed and
+                name_startswith == self.name_prefix and
+                not (status or host or tags)):
+            servers = self.server_index.refresh()
+        else:
+            if name_startswith:
+                kwargs['name'] = name_regex(name_startswith)
+            if status:
+                kwargs['status'] = status
+            if host:
+                kwargs['host'] = host
+            if tags:
+                kwargs['tags'] = ','.join(tags)
+            kwargs.setdefault('page_size', CONF.page_size)
+            servers = iter_servers(self.state.nova, detailed=detailed,
+                                   prefetch=prefetch, **kwargs)
+        for server in servers:
             if name_startswith and not server.name.startswith(name_startswith):
                 continue
             yield server
 
+    @listify
+    def list_servers(self, *args, **kwargs):
+        kwargs.setdefault('prefetch', True)
+        return self.iter_servers(*args, **kwargs)
+
     @listify
     def for_servers(self, fn, *args, **kwargs):
-        for server in self.list_servers():
+        for server in self.iter_servers():
             yield fn(server, *args, **kwargs)
 
+    def _for_servers_in(self, server_ids, fn, *args, **kwargs):
+        if not server_ids:
+            return
+        for server in self.iter_servers(incremental=True):
+            if server.id in server_ids:
+                yield fn(server, *args, **kwargs)
+
     @listify
     def for_servers_failed(self, testname, fn, *args, **kwargs):
-        servers = {server.id: server for server in self.list_servers()}
-        for host_and_server, result in self._test_results[testname].items():
-            host, server = host_and_server
-            if server in servers and issubclass(result.__class__, Failure):
-                yield fn(servers[server], *args, **kwargs)
+        return self._for_servers_in(self.results.failed_servers(testname),
+                                    fn, *args, **kwargs)
 
     @listify
     def for_servers_passed(self, testname, fn, *args, **kwargs):
-        servers = {server.id: server for server in self.list_servers()}
-        for host_and_server, result in self._test_results[testname].items():
-            host, server = host_and_server
-            if server in servers and issubclass(result.__class__, Success):
-                yield fn(servers[server], *args, **kwargs)
+        return self._for_servers_in(self.results.passed_servers(testname),
+                                    fn, *args, **kwargs)
 
     @listify
     def for_servers_active(self, fn, *args, **kwargs):
-        for server in self.list_servers():
+        for server in self.iter_servers(status='ACTIVE'):
             if not server.status == 'ACTIVE':
                 continue
             yield fn(server, *args, **kwargs)
 
     @listify
     def for_servers_errored(self, fn, *args, **kwargs):
-        for server in self.list_servers():
+        for server in self.iter_servers(status='ERROR'):
             if server.status == 'ERROR':
                 yield fn(server, *args, **kwargs)
 
     @listify
     def for_servers_building(self, fn, *args, **kwargs):
-        for server in self.list_servers():
+        for server in self.iter_servers(status='BUILD'):
             if server.status == 'BUILD':
                 yield fn(server, *args, **kwargs)
 
     def has_failed_tests(self, server):
-        servers = {
-            host_and_server[1]: host_and_server
-            for testname in self._test_results.keys()
-            for host_and_server, result in self._test_results[testname].items()
-            if issubclass(result.__class__, Failure)}
-        if server.id in servers:
-            return True
-        return False
+        return self.results.has_failures(getattr(server, 'id', server))
+
+    def tested_servers(self, host):
+        """The ids of the servers that have test results on a host."""
+        return self.results.servers_on_host(host)
+
+    def watch_server(self, server, states=('ACTIVE', 'ERROR'), timeout=None):
+        """Return a future that resolves once the server is in states."""
+        if timeout is None:
+            timeout = CONF.build_timeout
+        return self.watcher.watch(server, states, timeout)
+
+    def _iter_completed(self, servers, states, timeout):
+        finished = queue.Queue()
+        futures = [self.watch_server(server, states, timeout)
+                   for server in servers]
+        for future in futures:
+            future.add_done_callback(finished.put)
+        for _ in futures:
+            future = finished.get()
+            if future.exception() is not None:
+                LOG.warning("Timed out waiting for server %s",
+                            future.server_id)
+            yield future
+
+    def as_completed(self, servers, states=('ACTIVE', 'ERROR'),
+                     timeout=None):
+        """Yield each server as soon as it ends up in one of the states.
+
+        Servers that time out are still yielded, as they were last listed,
+        so that they can be reported on.
+        """
+        for future in self._iter_completed(servers, states, timeout):
+            yield future.latest if future.exception() else future.result()
 
-    @listify
     def wait_for_servers(self, servers,
                          states=('ACTIVE', 'ERROR'),
                          timeout=None):
         """Wait for servers to end up in one of the specified states.
 
+        The servers are returned in the order they finish.  Each server
+        has its own deadline, and once every server has finished or
+        timed out a ServerTimeout listing the ones that timed out is
+        raised if there are any.
         """
-        if timeout is None:
-            timeout = CONF.build_timeout
-        count = timeout
-        finished = False
-        uuids = set([server.id for server in servers])
-        if not uuids:
-            return []
-        while count > 0:
-            # If there are no servers then return
-            server_list = self.list_servers()
-            if not server_list:
-                return []
-
-            for server in server_list:
-                if server.id not in uuids:
-                    continue
-                if server.status not in states:
-                    finished = False
-                    break
-                if getattr(server, 'OS-EXT-STS:task_state'):
-                    # Break if a VM isn't in a stable state
-                    finished = False
-                    break
-                finished = True
-            count -= 1
-            if finished is True:
-                return servers
-            time.sleep(1)
-        raise Exception("Timed out waiting for servers.")
+        finished = []
+        timed_out = []
+        for future in self._iter_completed(servers, states, timeout):
+            if future.exception() is not None:
+                timed_out.append(future.latest)
+            else:
+                finished.append(future.result())
+
+        if timed_out:
+            raise ServerTimeout(
+                "Timed out waiting for servers %s."
+                % ', '.join(server.id for server in timed_out),
+                servers=timed_out, finished=finished)
+        return finished
+
+    def host_snapshot(self):
+        """The compute hosts and aggregates, for reporting offline."""
+        return {
+            'hosts': [service.host for service in self.list_hosts()],
+            'aggregates': self.aggregate_map.aggregates(),
+        }
 
     def report_results(self):
-        test_combinations = set()
-        for results in self._test_results.values():
-            test_combinations = test_combinations.union(set(results.keys()))
-        test_combinations = sorted(list(test_combinations))
-
-        tests = []
-        for ordered_test in [scenarios.BootScenario.name,
-                             scenarios.ConsoleScenario.name,
-                             scenarios.VNCConsoleScenario.name,
-                             scenarios.FloatScenario.name]:
-            if ordered_test in self._test_results.keys():
-                tests.append(ordered_test)
-        tests = tests + [test for test in self._test_results.keys()
-                         if test not in tests]
-
-        pt = PrettyTable(['Host ID', 'Server ID'] + tests)
-        pt.align = 'l'
-        missing_hosts = set(service.host for service in self.list_hosts())
-
-        for host, server in test_combinations:
-            if host in missing_hosts:
-                missing_hosts.remove(host)
-            row = [host, server]
-            for test in tests:
-                row.append(str(self.get_test_result(test, host, server)))
-            pt.add_row(row)
-        return pt, missing_hosts
+        return report.results_table(
+            self.results.snapshot(),
+            [service.host for service in self.list_hosts()])
 
     def report_failures(self):
-        failures = {}
-        for test in self._test_results:
-            failures[test] = []
-            for key, result in self._test_results[test].items():
-                if not issubclass(result.__class__, Failure):
-                    continue
-                host, server = key
-                failures[test].append((host, server, result))
-        return failures
+        return report.failures(self.results.snapshot())
 
     def report_errors(self):
-        errors = {}
-        for test in self._test_results:
-            errors[test] = []
-            for key, result in self._test_results[test].items():
-                if not issubclass(result.__class__, Error):
-                    continue
-                host, server = key
-                errors[test].append((host, server, result))
-        return errors
+        return report.errors(self.results.snapshot())
 
     def report_aggregates(self, all_hosts=False):
         if all_hosts:
             hosts = [host.host for host in self.list_hosts()]
         else:
-            hosts = set()
-            for results in self._test_results.values():
-                hosts = hosts.union(set(results.keys()))
-            hosts = sorted(list(hosts))
-            hosts = set(host for host, server in hosts)
-        pt = PrettyTable(['Host ID', 'Aggregates'])
-        pt.align = 'l'
-        aggregates = defaultdict(list)
-        for agg in self.state.nova.aggregates.list():
-            for host in agg.hosts:
-                aggregates[host].append(agg.name)
-
-        for host in sorted(hosts):
-            pt.add_row([host, ','.join(aggregates.get(host, []))])
-        return pt
+            hosts = set(host for test, host, server, result
+                        in self.results.items())
+        return report.aggregates_table(hosts, self.aggregate_map.by_host())
+
+    def report_rollup(self):
+        return report.rollup_table(self.results.snapshot(),
+                                   self.aggregate_map.by_host())
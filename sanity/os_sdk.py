@@ -14,28 +14,509 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
+import logging
+import os
+import re
+import stat
+import threading
+import time
+from datetime import datetime
+from functools import partial
+from os import path
+
 import openstack.profile
 import openstack.connection
 import openstack.session
 from positional import positional
+from keystoneauth1 import access
 from keystoneauth1 import exceptions
 from keystoneauth1.identity.generic.password import Password as BasePassword
+from keystoneauth1.session import TCPKeepAliveAdapter
+from novaclient import client as no_client
 from oslo_config import cfg
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import connectionpool
+from six.moves.urllib.parse import urlparse
+
+from sanity.util import Coalescer
 
 
+LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+# Requests' own default number of connections kept open to each endpoint
+DEFAULT_POOL_SIZE = 10
+# Threads that use the connection besides the workers, the booter, the
+# waiter, the server watcher and the main thread.
+EXTRA_WORKERS = 4
+
+# The URL path segment of each resource the response cache knows about
+CACHED_RESOURCES = {
+    'flavors': 'flavors',
+    'images': 'images',
+    'networks': 'networks',
+    'os-availability-zone': 'availability_zones',
+    'os-services': 'services',
+    'os-aggregates': 'aggregates',
+}
+CACHE_TTLS = {
+    'flavors': 600,
+    'images': 600,
+    'networks': 60,
+    'availability_zones': 300,
+    'services': 60,
+    'aggregates': 300,
+}
+
+opts = [
+    cfg.StrOpt('token-cache', default=None,
+               help="A file to keep Keystone tokens and service catalogs "
+               "in between runs."),
+    cfg.IntOpt('token-cache-refresh', default=300,
+               help="Don't use cached tokens that expire within this many "
+               "seconds."),
+    cfg.IntOpt('token-refresh', default=300,
+               help="Fetch a new token in the background this many seconds "
+               "before the current one expires, 0 waits for it to expire."),
+    cfg.IntOpt('http-pool-size', default=None,
+               help="The number of connections to keep open to each API "
+               "endpoint, defaults to enough for every thread."),
+    cfg.BoolOpt('http-pool-block', default=False,
+                help="Wait for a pooled connection rather than opening "
+                "extra connections that are closed after one request."),
+    cfg.BoolOpt('http-keep-alive', default=True,
+                help="Send TCP keep-alive probes on idle connections."),
+    cfg.BoolOpt('coalesce-gets', default=True,
+                help="Share one request between threads making the same "
+                "API GET at the same time."),
+    cfg.FloatOpt('coalesce-ttl', default=0,
+                 help="Seconds to keep answering identical GETs with a "
+                 "finished response."),
+    cfg.DictOpt('cache-ttl', default={},
+                help="Seconds to cache the responses for each of %s, for "
+                "example flavors:600,services:30.  0 doesn't cache that "
+                "resource." % ', '.join(sorted(CACHE_TTLS))),
+]
+
+CONF.register_opts(opts)
+CONF.register_cli_opts(opts)
+
+
+class TokenCache(object):
+    """A JSON file of Keystone tokens, one per cloud, user and project.
+
+    Each entry is the plugin's auth state, the token and the body it was
+    issued with, which includes the service catalog.  The file is only
+    ever readable by its owner, and tokens that expire within refresh
+    seconds are ignored so a run doesn't start on a token that's about
+    to run out.
+    """
+
+    def __init__(self, filename, refresh=300):
+        self.filename = path.abspath(path.expanduser(filename))
+        self.refresh = refresh
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(auth_url, username, project_name):
+        return ' '.join([auth_url, username, project_name])
+
+    def _read(self):
+        try:
+            mode = os.stat(self.filename).st_mode
+            if mode & (stat.S_IRWXG | stat.S_IRWXO):
+                LOG.warning("Ignoring token cache %s, it's readable by other "
+                            "users.", self.filename)
+                return {}
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            LOG.warning("Ignoring unreadable token cache %s", self.filename)
+            return {}
+
+    def load(self, key):
+        """Return the cached auth state, if it isn't about to expire."""
+        state = self._read().get(key)
+        if not state:
+            return None
+        try:
+            data = json.loads(state)
+            auth_ref = access.create(body=data['body'],
+                                     auth_token=data['auth_token'])
+            if auth_ref.will_expire_soon(self.refresh):
+                return None
+        except Exception:
+            LOG.warning("Ignoring unreadable cached token for %s", key)
+            return None
+        return state
+
+    def save(self, key, state):
+        with self._lock:
+            cache = self._read()
+            cache[key] = state
+            tmp_filename = '%s.%s.tmp' % (self.filename, os.getpid())
+            fd = os.open(tmp_filename,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f, indent=2, sort_keys=True)
+            os.rename(tmp_filename, self.filename)
+
 
 class Password(BasePassword):
+    """A password plugin that refreshes its token once for every thread.
+
+    Threads share the plugin, so when a token is rejected every thread
+    that used it invalidates it.  Only the first of them drops the
+    token, the rest retry with the token fetched in the meantime rather
+    than each logging in again.  With refresh_before set, a new token is
+    fetched in the background that many seconds before the current one
+    expires, so the threads don't have to wait for one at all.
+    """
+
+    token_cache = None
+    cache_key = None
+    refresh_before = None
+    # Invalidations this soon after a new token was fetched are assumed to
+    # be for the token it replaced.
+    reauth_grace = 10
+
+    def __init__(self, *args, **kwargs):
+        super(Password, self).__init__(*args, **kwargs)
+        self._new_token_lock = threading.Lock()
+        self._seen_ref = None
+        self._cached_ref = None
+        self._refreshed_at = 0
+        self._timer = None
+
     @positional()
     def get_discovery(self, session, url, authenticated=None):
         raise exceptions.DiscoveryFailure()
 
+    def use_token_cache(self, token_cache, key):
+        """Start from a cached token and cache every new one."""
+        self.token_cache = token_cache
+        self.cache_key = key
+        state = token_cache.load(key)
+        if state:
+            LOG.debug("Using cached token for %s", key)
+            self.set_auth_state(state)
+            self._cached_ref = self.auth_ref
+
+    def get_auth_ref(self, session, **kwargs):
+        auth_ref = super(Password, self).get_auth_ref(session, **kwargs)
+        self._refreshed_at = time.time()
+        return auth_ref
+
+    def get_access(self, session, **kwargs):
+        auth_ref = super(Password, self).get_access(session, **kwargs)
+        if auth_ref is not self._seen_ref:
+            with self._new_token_lock:
+                if auth_ref is not self._seen_ref:
+                    self._seen_ref = auth_ref
+                    self._new_token(session, auth_ref)
+        return auth_ref
+
+    def invalidate(self):
+        with self._lock:
+            if time.time() - self._refreshed_at < self.reauth_grace:
+                return True
+            return super(Password, self).invalidate()
+
+    def _new_token(self, session, auth_ref):
+        if self.token_cache is not None and auth_ref is not self._cached_ref:
+            try:
+                self.token_cache.save(self.cache_key, self.get_auth_state())
+            except (IOError, OSError) as e:
+                LOG.warning("Failed to save token cache %s: %s",
+                            self.token_cache.filename, e)
+        if self.refresh_before:
+            self._schedule_refresh(session, auth_ref)
+
+    def _schedule_refresh(self, session, auth_ref):
+        expires = auth_ref.expires
+        remaining = (expires - datetime.now(expires.tzinfo)).total_seconds()
+        # Tokens that don't live much longer than refresh_before are
+        # refreshed half way through instead, rather than continuously.
+        delay = max(remaining - self.refresh_before, remaining / 2)
+        self.stop_refresh()
+        self._timer = threading.Timer(delay, self._refresh, (session,))
+        self._timer.setName('TokenRefresh')
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh(self, session):
+        LOG.debug("Refreshing the token before it expires")
+        try:
+            with self._lock:
+                self.auth_ref = self.get_auth_ref(session)
+            self.get_access(session)
+        except Exception:
+            LOG.exception("Failed to refresh the token, it will be "
+                          "refreshed when it expires instead.")
+
+    def stop_refresh(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+def default_pool_size(workers=0):
+    """The connection pool size for a number of worker threads."""
+    if CONF.http_pool_size:
+        return CONF.http_pool_size
+    return max(DEFAULT_POOL_SIZE, (workers or 0) + EXTRA_WORKERS)
+
+
+class PoolStats(object):
+    """Counts of how the HTTP connection pools are used.
+
+    hits are requests sent on a pooled connection and misses had to
+    create one because the pool was empty.  connections counts every new
+    TCP connection, including pooled ones that had been dropped, and
+    discarded counts connections closed because the pool was full.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.misses = 0
+        self.connections = 0
+        self.discarded = 0
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @property
+    def hits(self):
+        return self.checkouts - self.misses
+
+    def __str__(self):
+        return ("%s hits, %s misses, %s new connections, %s discarded"
+                % (self.hits, self.misses, self.connections, self.discarded))
+
+
+class CountingPoolMixin(object):
+    stats = None
+
+    def _count(self, name):
+        if self.stats is not None:
+            self.stats.count(name)
+
+    def _get_conn(self, timeout=None):
+        self._count('checkouts')
+        return super(CountingPoolMixin, self)._get_conn(timeout)
+
+    def _new_conn(self):
+        self._count('misses')
+        return super(CountingPoolMixin, self)._new_conn()
+
+    def _put_conn(self, conn):
+        if self.pool is not None and self.pool.full():
+            self._count('discarded')
+        return super(CountingPoolMixin, self)._put_conn(conn)
+
+    def _make_request(self, conn, *args, **kwargs):
+        if getattr(conn, 'sock', None) is None:
+            self._count('connections')
+        return super(CountingPoolMixin, self)._make_request(
+            conn, *args, **kwargs)
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin,
+                                 connectionpool.HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin,
+                                  connectionpool.HTTPSConnectionPool):
+    pass
+
+
+class PoolAdapter(TCPKeepAliveAdapter):
+    """An adapter whose connection pools count their use in stats."""
+
+    def __init__(self, stats, keep_alive=True, **kwargs):
+        self.stats = stats
+        self.keep_alive = keep_alive
+        super(PoolAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            super(PoolAdapter, self).init_poolmanager(*args, **kwargs)
+        else:
+            HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+    def get_connection(self, url, proxies=None):
+        pool = super(PoolAdapter, self).get_connection(url, proxies)
+        pool.stats = self.stats
+        return pool
+
+
+class ResponseCache(object):
+    """GET responses for resources that rarely change, kept for a TTL.
+
+    ttls is {resource: seconds}, resources are recognised by their path
+    in the request URL.  Anything but a GET to a resource drops its
+    cached responses.  Expired responses that came with an ETag or
+    Last-Modified header are revalidated with a conditional GET rather
+    than fetched again.
+    """
+
+    def __init__(self, ttls):
+        self.ttls = dict((resource, float(ttl))
+                         for resource, ttl in ttls.items() if float(ttl))
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generations = {}
+        paths = [path for path, resource in CACHED_RESOURCES.items()
+                 if resource in self.ttls]
+        self._pattern = None
+        if paths:
+            self._pattern = re.compile(r'(?:^|/)(%s)(?:[/.]|$)' % '|'.join(
+                re.escape(path) for path in paths))
+
+    def resource(self, url):
+        """The cached resource a URL is for, or None."""
+        if self._pattern is None:
+            return None
+        match = self._pattern.search(urlparse(url).path)
+        if match is None:
+            return None
+        return CACHED_RESOURCES[match.group(1)]
+
+    def invalidate(self, resource):
+        with self._lock:
+            self._generations[resource] = (
+                self._generations.get(resource, 0) + 1)
+            for key, entry in list(self._entries.items()):
+                if entry[0] == resource:
+                    del self._entries[key]
+
+    def get(self, key, resource, fetch):
+        """Return the cached response, or the one fetch(headers) returns.
+
+        headers are the conditional request headers for an expired
+        response, if there are any.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generations.get(resource, 0)
+            if entry is not None and entry[1] > time.time():
+                self.hits += 1
+                return entry[2]
+
+        headers = {}
+        if entry is not None:
+            cached = entry[2]
+            if cached.headers.get('ETag'):
+                headers['If-None-Match'] = cached.headers['ETag']
+            if cached.headers.get('Last-Modified'):
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+        response = fetch(headers)
+
+        with self._lock:
+            if headers and response.status_code == 304:
+                self.revalidated += 1
+                response = entry[2]
+            else:
+                self.misses += 1
+            # Don't keep a response that was fetched before a change
+            if (200 <= response.status_code < 300 and
+                    generation == self._generations.get(resource, 0)):
+                self._entries[key] = (resource,
+                                      time.time() + self.ttls[resource],
+                                      response)
+        return response
+
+    def __str__(self):
+        return ("%s hits, %s misses, %s revalidated"
+                % (self.hits, self.misses, self.revalidated))
+
+
+def invalidate_cached(client, resource):
+    """Drop a resource's cached responses from a novaclient's session."""
+    session = getattr(getattr(client, 'client', None), 'session', None)
+    response_cache = getattr(session, 'response_cache', None)
+    if isinstance(response_cache, ResponseCache):
+        response_cache.invalidate(resource)
+
 
 class Session(openstack.session.Session):
-    def request(self, *args, **kwargs):
+    """A session that keeps pool_size connections open to each endpoint.
+
+    With a coalescer, identical GETs that overlap share one request and
+    its response, so threads polling the same list don't each send it.
+    With a response cache, GETs of the resources it caches are answered
+    from it until they expire.
+    """
+
+    def __init__(self, profile, pool_size=DEFAULT_POOL_SIZE,
+                 pool_block=False, keep_alive=True, coalescer=None,
+                 response_cache=None, **kwargs):
+        super(Session, self).__init__(profile, **kwargs)
+        self.pool_stats = PoolStats()
+        self.coalescer = coalescer
+        self.response_cache = response_cache
+        adapter = PoolAdapter(self.pool_stats, keep_alive=keep_alive,
+                              pool_maxsize=pool_size, pool_block=pool_block)
+        for scheme in ('https://', 'http://'):
+            self.session.mount(scheme, adapter)
+
+    def request(self, url, method, **kwargs):
         kwargs.setdefault('connect_retries', 5)
-        return super(Session, self).request(*args, **kwargs)
+        resource = None
+        if self.response_cache is not None:
+            resource = self.response_cache.resource(url)
+        if method.upper() != 'GET' or kwargs.get('stream'):
+            if resource is not None:
+                self.response_cache.invalidate(resource)
+            return super(Session, self).request(url, method, **kwargs)
+
+        if resource is not None:
+            key = self._request_key(url, kwargs)
+            if key is not None:
+                return self.response_cache.get(
+                    key, resource,
+                    partial(self._conditional_get, url, method, kwargs))
+        return self._coalesced_get(url, method, **kwargs)
+
+    def _conditional_get(self, url, method, kwargs, headers):
+        if headers:
+            kwargs = dict(kwargs)
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **headers)
+        return self._coalesced_get(url, method, **kwargs)
+
+    def _coalesced_get(self, url, method, **kwargs):
+        key = None
+        if self.coalescer is not None:
+            key = self._request_key(url, kwargs)
+        if key is None:
+            return super(Session, self).request(url, method, **kwargs)
+        return self.coalescer.call(key, self._shared_request,
+                                   url, method, **kwargs)
+
+    def _shared_request(self, url, method, **kwargs):
+        response = super(Session, self).request(url, method, **kwargs)
+        # Read the body before handing the response to other threads
+        response.content
+        return response
+
+    def _request_key(self, url, kwargs):
+        try:
+            return json.dumps([url, kwargs], sort_keys=True, default=repr)
+        except (TypeError, ValueError):
+            return None
 
 
 def create_connection(auth_url, project_name, username, password,
@@ -44,7 +525,9 @@ def create_connection(auth_url, project_name, username, password,
                       project_domain_id='default',
                       verify=True,
                       cert=None,
-                      identity_version=None):
+                      identity_version=None,
+                      token_cache=None,
+                      pool_size=None):
     profile = openstack.profile.Profile()
     profile.set_interface(profile.ALL, endpoint_type)
 
@@ -74,8 +557,27 @@ def create_connection(auth_url, project_name, username, password,
             username=username,
             password=password)
 
+    authenticator.refresh_before = CONF.token_refresh or None
+
+    if token_cache is None and CONF.token_cache:
+        token_cache = TokenCache(CONF.token_cache, CONF.token_cache_refresh)
+    if token_cache is not None:
+        authenticator.use_token_cache(
+            token_cache, TokenCache.key(auth_url, username, project_name))
+
+    if pool_size is None:
+        pool_size = default_pool_size()
+    coalescer = None
+    if CONF.coalesce_gets:
+        coalescer = Coalescer(ttl=CONF.coalesce_ttl)
+    ttls = dict(CACHE_TTLS, **CONF.cache_ttl)
     session = Session(
         profile,
+        pool_size=pool_size,
+        coalescer=coalescer,
+        response_cache=ResponseCache(ttls),
+        pool_block=CONF.http_pool_block,
+        keep_alive=CONF.http_keep_alive,
         user_agent='Sanity',
         auth=authenticator,
         verify=verify,
@@ -85,3 +587,67 @@ def create_connection(auth_url, project_name, username, password,
         session=session,
         authenticator=authenticator,
         profile=profile)
+
+
+class Clients(object):
+    """A connection and the clients that share its session."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.session = connection.session
+        self.keystone = connection.identity
+        self.neutron = connection.network
+        self.glance = connection.image
+        self.nova = no_client.Client('2', session=connection.session)
+
+    def close(self):
+        self.session.auth.stop_refresh()
+
+
+class ConnectionManager(object):
+    """Share one authenticated connection per set of credentials.
+
+    Every caller that acquires the same credentials gets the same
+    Clients, so the Keystone token and the HTTP connection pool are
+    shared instead of each one logging in again.  The connection is
+    dropped once everyone that acquired it has released it.
+
+    pool_size only applies to the caller that creates the connection,
+    later callers share whatever pool it was created with.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._refs = {}
+
+    def acquire(self, auth_url, project_name, username, password,
+                pool_size=None, **kwargs):
+        key = (auth_url, project_name, username, password,
+               tuple(sorted(kwargs.items())))
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = Clients(create_connection(
+                    auth_url, project_name, username, password,
+                    pool_size=pool_size, **kwargs))
+                self._refs[key] = 0
+            self._refs[key] += 1
+            return self._clients[key]
+
+    def release(self, clients):
+        with self._lock:
+            for key, shared in self._clients.items():
+                if shared is clients:
+                    self._refs[key] -= 1
+                    if not self._refs[key]:
+                        del self._clients[key]
+                        del self._refs[key]
+                        clients.close()
+                    return
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+
+connections = ConnectionManager()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import re
+import time
+from collections import namedtuple
+
+from prettytable import PrettyTable
+
+from sanity.util import RateLimiter, run_graph, run_parallel
+
+LOG = logging.getLogger(__name__)
+
+SERVERS = 'server'
+FLOATING_IPS = 'floating ip'
+PORTS = 'port'
+SECURITY_GROUPS = 'security group'
+
+# The order the tables are printed in
+KINDS = [SERVERS, FLOATING_IPS, PORTS, SECURITY_GROUPS]
+
+# Servers from before the Sanity- prefix
+OLD_SERVER_PREFIXES = ['Span-Client-']
+
+Orphan = namedtuple('Orphan', ['kind', 'id', 'name', 'resource'])
+
+
+class Reconciler(object):
+    """Find and delete the resources left behind by interrupted runs.
+
+    Each kind of resource is listed once and matched against the names
+    sanity gives its resources in memory: servers, floating IPs that
+    aren't attached to a port, ports on the sanity network that aren't
+    attached to a device and sanity's security groups.  Deletes run
+    max_workers at a time and at most rate per second.
+    """
+
+    def __init__(self, state, controller, max_workers=10, rate=None,
+                 timeout=300):
+        self.state = state
+        self.controller = controller
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(rate)
+        self.timeout = timeout
+
+    def _project_id(self):
+        return self.state.keystone.session.get_project_id()
+
+    def _find_servers(self):
+        orphans = []
+        for prefix in [self.controller.name_prefix] + OLD_SERVER_PREFIXES:
+            for server in self.controller.iter_servers(
+                    name_startswith=prefix, detailed=False):
+                orphans.append(Orphan(SERVERS, server.id, server.name,
+                                      server))
+        return orphans
+
+    def _find_floating_ips(self):
+        return [Orphan(FLOATING_IPS, ip['id'],
+                       ip['floating_ip_address'], ip)
+                for ip in self.state.neutron.ips(
+                    tenant_id=self._project_id())
+                if ip['port_id'] is None]
+
+    def _find_ports(self):
+        project_id = self._project_id()
+        networks = set(network['id'] for network in
+                       self.state.neutron.networks(
+                           tenant_id=project_id,
+                           name=self.state._network_name))
+        if not networks:
+            return []
+        return [Orphan(PORTS, port['id'], port['name'], port)
+                for port in self.state.neutron.ports(tenant_id=project_id)
+                if port['network_id'] in networks and
+                not port['device_id']]
+
+    def _find_security_groups(self):
+        name_re = re.compile(
+            self.state._security_group_name.format('.*') + '$')
+        return [Orphan(SECURITY_GROUPS, group['id'], group['name'], group)
+                for group in self.state.neutron.security_groups(
+                    tenant_id=self._project_id())
+                if name_re.match(group['name'])]
+
+    def find(self):
+        """List each kind of resource once, returns {kind: [Orphan]}."""
+        return run_graph({
+            SERVERS: (self._find_servers, []),
+            FLOATING_IPS: (self._find_floating_ips, []),
+            PORTS: (self._find_ports, []),
+            SECURITY_GROUPS: (self._find_security_groups, []),
+        })
+
+    def report(self, orphans):
+        pt = PrettyTable(['Type', 'ID', 'Name'])
+        pt.align = 'l'
+        for kind in KINDS:
+            for orphan in orphans.get(kind, []):
+                pt.add_row([orphan.kind, orphan.id, orphan.name])
+        return pt
+
+    def _delete_one(self, orphan):
+        self.limiter.wait()
+        LOG.info("Deleting %s %s (%s)", orphan.kind, orphan.name, orphan.id)
+        if orphan.kind == SERVERS:
+            orphan.resource.delete()
+        elif orphan.kind == FLOATING_IPS:
+            self.state.neutron.delete_ip(orphan.id)
+        elif orphan.kind == PORTS:
+            self.state.neutron.delete_port(orphan.id)
+        elif orphan.kind == SECURITY_GROUPS:
+            self.state.neutron.delete_security_group(orphan.id)
+
+    def _delete_all(self, orphans, failed):
+        def delete(orphan):
+            try:
+                self._delete_one(orphan)
+            except Exception as e:
+                LOG.warning("Failed to delete %s %s: %s",
+                            orphan.kind, orphan.id, e)
+                failed.append(orphan)
+        run_parallel(delete, orphans, max_workers=self.max_workers)
+
+    def _wait_deleted(self, servers, interval=1, max_interval=10):
+        """Wait until the servers are no longer listed by Nova.
+
+        The servers are listed directly rather than through the server
+        watcher, whose index only holds servers with the current name
+        prefix.  Returns the ids of the servers that still exist.
+        """
+        deadline = time.time() + self.timeout
+        remaining = set(server.id for server in servers)
+        while True:
+            remaining &= set(orphan.id for orphan in self._find_servers())
+            if not remaining or time.time() >= deadline:
+                return remaining
+            time.sleep(min(interval, max(deadline - time.time(), 0)))
+            interval = min(interval * 1.5, max_interval)
+
+    def _delete_servers(self, servers, failed):
+        self._delete_all(servers, failed)
+        deleted = [orphan for orphan in servers if orphan not in failed]
+        if not deleted:
+            return
+        # Security groups can't be deleted while servers still use them
+        remaining = self._wait_deleted(deleted)
+        if remaining:
+            LOG.warning("Timed out waiting for servers %s to delete",
+                        ', '.join(sorted(remaining)))
+            failed.extend(orphan for orphan in deleted
+                          if orphan.id in remaining)
+
+    def delete(self, orphans):
+        """Delete the orphans, returns the ones that couldn't be."""
+        failed = []
+        run_graph({
+            SERVERS: (lambda: self._delete_servers(
+                orphans.get(SERVERS, []), failed), []),
+            FLOATING_IPS: (lambda: self._delete_all(
+                orphans.get(FLOATING_IPS, []), failed), []),
+            PORTS: (lambda: self._delete_all(
+                orphans.get(PORTS, []), failed), []),
+            SECURITY_GROUPS: (lambda: self._delete_all(
+                orphans.get(SECURITY_GROUPS, []), failed), [SERVERS]),
+        })
+        return failed
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import logging
+import math
+from collections import defaultdict
+
+from prettytable import PrettyTable
+
+from sanity import results
+from sanity import scenarios
+from sanity import sink
+
+LOG = logging.getLogger(__name__)
+
+ALL_HOSTS = '(all)'
+NO_AGGREGATE = '(none)'
+
+
+def results_table(test_results, hosts=()):
+    """Build the results table.
+
+    test_results is {test: {(host, server): result}}.  Returns the table
+    and the set of hosts that have no results.
+    """
+    test_combinations = set()
+    for test in test_results.values():
+        test_combinations = test_combinations.union(set(test.keys()))
+    test_combinations = sorted(list(test_combinations))
+
+    tests = []
+    for ordered_test in [scenarios.BootScenario.name,
+                         scenarios.ConsoleScenario.name,
+                         scenarios.VNCConsoleScenario.name,
+                         scenarios.FloatScenario.name]:
+        if ordered_test in test_results.keys():
+            tests.append(ordered_test)
+    tests = tests + [test for test in test_results.keys()
+                     if test not in tests]
+
+    pt = PrettyTable(['Host ID', 'Server ID'] + tests)
+    pt.align = 'l'
+    missing_hosts = set(hosts)
+
+    for host, server in test_combinations:
+        if host in missing_hosts:
+            missing_hosts.remove(host)
+        row = [host, server]
+        for test in tests:
+            row.append(str(test_results[test].get((host, server))))
+        pt.add_row(row)
+    return pt, missing_hosts
+
+
+def _results_of_type(test_results, result_class):
+    found = {}
+    for test, test_result in test_results.items():
+        found[test] = []
+        for key, result in test_result.items():
+            if not issubclass(result.__class__, result_class):
+                continue
+            host, server = key
+            found[test].append((host, server, result))
+    return found
+
+
+def failures(test_results):
+    return _results_of_type(test_results, results.Failure)
+
+
+def errors(test_results):
+    return _results_of_type(test_results, results.Error)
+
+
+def host_aggregates(aggregates):
+    """Invert {aggregate: [host, ...]} to {host: [aggregate, ...]}."""
+    by_host = defaultdict(list)
+    for name, hosts in aggregates.items():
+        for host in hosts:
+            by_host[host].append(name)
+    return by_host
+
+
+def aggregates_table(hosts, aggregates):
+    """Build the table of the aggregates each host is in.
+
+    aggregates is {host: [aggregate, ...]}.
+    """
+    pt = PrettyTable(['Host ID', 'Aggregates'])
+    pt.align = 'l'
+    for host in sorted(hosts):
+        pt.add_row([host, ','.join(aggregates.get(host, []))])
+    return pt
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def rollup(test_results, aggregates):
+    """Count the results and their durations by aggregate and test.
+
+    aggregates is {host: [aggregate, ...]}, hosts in no aggregate are
+    counted under NO_AGGREGATE and every host is counted under
+    ALL_HOSTS.  Returns {(aggregate, test): {'hosts', 'pass', 'fail',
+    'error', 'skipped', 'p50', 'p95'}}.
+    """
+    groups = defaultdict(lambda: {'hosts': set(), 'pass': 0, 'fail': 0,
+                                  'error': 0, 'skipped': 0,
+                                  'durations': []})
+    for test, test_result in test_results.items():
+        for (host, server), result in test_result.items():
+            names = aggregates.get(host) or [NO_AGGREGATE]
+            for name in [ALL_HOSTS] + list(names):
+                group = groups[(name, test)]
+                group['hosts'].add(host)
+                if isinstance(result, results.Error):
+                    group['error'] += 1
+                elif result.is_failure():
+                    group['fail'] += 1
+                elif isinstance(result, results.Skipped):
+                    group['skipped'] += 1
+                    continue
+                else:
+                    group['pass'] += 1
+                group['durations'].append(result.duration.total_seconds())
+
+    rolled_up = {}
+    for key, group in groups.items():
+        durations = sorted(group.pop('durations'))
+        group['hosts'] = len(group['hosts'])
+        group['p50'] = percentile(durations, 50)
+        group['p95'] = percentile(durations, 95)
+        rolled_up[key] = group
+    return rolled_up
+
+
+def _seconds(value):
+    return '' if value is None else '%.1f' % value
+
+
+def rollup_table(test_results, aggregates):
+    """Build a table of the result counts for each aggregate and test."""
+    pt = PrettyTable(['Aggregate', 'Test', 'Hosts', 'Pass', 'Fail',
+                      'Error', 'Skipped', 'p50 (s)', 'p95 (s)'])
+    pt.align = 'l'
+    rolled_up = rollup(test_results, aggregates)
+
+    def sort_key(key):
+        name, test = key
+        return (name != ALL_HOSTS, name == NO_AGGREGATE, name, test)
+
+    for key in sorted(rolled_up, key=sort_key):
+        group = rolled_up[key]
+        pt.add_row(list(key) + [group['hosts'], group['pass'],
+                                group['fail'], group['error'],
+                                group['skipped'], _seconds(group['p50']),
+                                _seconds(group['p95'])])
+    return pt
+
+
+class StoredResults(object):
+    """Reports from saved results, without talking to the cloud.
+
+    Provides the report methods of SanityController over results read
+    from a result stream or a JSON report.  Hosts and aggregates come
+    from the snapshot written at the start of the run, when there is one.
+    """
+
+    def __init__(self, test_results, snapshot=None):
+        self.test_results = test_results
+        snapshot = snapshot or {}
+        self.hosts = snapshot.get('hosts', [])
+        self.aggregates = host_aggregates(snapshot.get('aggregates', {}))
+
+    @classmethod
+    def load(cls, filename, snapshot_filename=None):
+        records = read_records(filename)
+        if records is None:
+            with open(filename) as f:
+                report = json.load(f)
+            snapshot = None
+        else:
+            records = list(records)
+            report = sink.fold_results(records)
+            snapshot = sink.find_snapshot(records)
+        if snapshot_filename:
+            snapshot = sink.find_snapshot(sink.read_results(
+                snapshot_filename))
+        if snapshot is None:
+            LOG.warning("No host snapshot found, untested hosts and "
+                        "aggregates won't be reported.")
+        test_results = {}
+        for test, test_results_list in report.items():
+            test_results[test] = dict(
+                ((host, server), results.from_dict(result))
+                for host, server, result in test_results_list)
+        return cls(test_results, snapshot)
+
+    def filter(self, hosts=None, tests=None):
+        """Return the results for only some hosts and tests."""
+        hosts = set(hosts) if hosts else None
+        test_results = {}
+        for test, test_result in self.test_results.items():
+            if tests and test not in tests:
+                continue
+            test_results[test] = dict(
+                (key, result) for key, result in test_result.items()
+                if hosts is None or key[0] in hosts)
+        filtered = self.__class__(test_results)
+        filtered.hosts = [host for host in self.hosts
+                          if hosts is None or host in hosts]
+        filtered.aggregates = self.aggregates
+        return filtered
+
+    def report_results(self):
+        return results_table(self.test_results, self.hosts)
+
+    def report_failures(self):
+        return failures(self.test_results)
+
+    def report_errors(self):
+        return errors(self.test_results)
+
+    def report_aggregates(self, all_hosts=False):
+        if all_hosts:
+            hosts = self.hosts
+        else:
+            hosts = set(host for test_result in self.test_results.values()
+                        for host, server in test_result)
+        return aggregates_table(hosts, self.aggregates)
+
+    def report_rollup(self):
+        return rollup_table(self.test_results, self.aggregates)
+
+
+def read_records(filename):
+    """Read a result stream, or return None if the file isn't one."""
+    records = sink.read_results(filename)
+    try:
+        first = next(records)
+    except (StopIteration, ValueError):
+        return None
+    if not isinstance(first, dict) or not (
+            'snapshot' in first or ('test' in first and 'result' in first)):
+        return None
+
+    def chain():
+        yield first
+        for record in records:
+            yield record
+    return chain()
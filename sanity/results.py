@@ -15,16 +15,98 @@
 #    under the License.
 
 
+from array import array
+from collections import defaultdict, Counter
 from datetime import timedelta
+import logging
+import threading
 import traceback
 
 import six
 
+LOG = logging.getLogger(__name__)
+
+# Integer status codes, used by the compact result table.
+SUCCESS = 0
+FAILURE = 1
+ERROR = 2
+SKIPPED = 3
+UNKNOWN = 4
+
+
+def intern_string(value):
+    """Intern a native string so repeated values share one copy."""
+    if isinstance(value, str):
+        return six.moves.intern(value)
+    return value
+
 
 class Result(object):
-    duration = timedelta(seconds=0)
+    """The result of a single test.
+
+    Results use __slots__ so a run over thousands of hosts doesn't carry
+    a __dict__ per result.  The duration is stored as float seconds and
+    exposed as a timedelta.  Any extra keyword arguments are kept in the
+    extra dict and can be read back as attributes.
+    """
+    __slots__ = ('_duration', 'extra')
+    status_code = UNKNOWN
     _is_failure = False
 
+    def __init__(self, **kwargs):
+        self._duration = 0.0
+        self.extra = None
+        for k, v in kwargs.items():
+            self._set(k, v)
+
+    def _set(self, name, value):
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails, unset slots included.
+        if name == 'extra' or name.startswith('__'):
+            raise AttributeError(name)
+        if self.extra and name in self.extra:
+            return self.extra[name]
+        raise AttributeError("%r object has no attribute %r"
+                             % (self.__class__.__name__, name))
+
+    @classmethod
+    def _slots(cls):
+        for klass in cls.__mro__:
+            for slot in getattr(klass, '__slots__', ()):
+                yield slot
+
+    def __getstate__(self):
+        state = {}
+        for slot in self._slots():
+            value = getattr(self, slot, None)
+            if value is not None:
+                state[slot] = value
+        return state
+
+    def __setstate__(self, state):
+        for slot in self._slots():
+            setattr(self, slot, None)
+        self._duration = 0.0
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    @property
+    def duration(self):
+        return timedelta(seconds=self._duration)
+
+    @duration.setter
+    def duration(self, value):
+        if isinstance(value, timedelta):
+            value = value.total_seconds()
+        self._duration = float(value)
+
     def is_failure(self):
         return self._is_failure
 
@@ -36,18 +118,24 @@ class Result(object):
 
 
 class Success(Result):
-    pass
+    __slots__ = ()
+    status_code = SUCCESS
+
+    def __str__(self):
+        seconds = self.duration.seconds
+        return 'PASS {:02}:{:02}'.format(seconds % 3600 // 60, seconds % 60)
 
 
 class Failure(Result):
+    __slots__ = ('reason', 'exception', 'traceback')
+    status_code = FAILURE
     _is_failure = True
-    exception = None
-    traceback = None
 
     def __init__(self, reason="", exception=None, *args, **kwargs):
-        self.reason = reason
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+        self.reason = intern_string(reason)
+        self.exception = None
+        self.traceback = None
+        super(Failure, self).__init__(**kwargs)
         if isinstance(exception, six.string_types):
             self.exception = exception
         elif exception:
@@ -73,6 +161,8 @@ class Failure(Result):
 
 
 class Error(Failure):
+    __slots__ = ()
+    status_code = ERROR
 
     def __init__(self, *args, **kwargs):
         super(Error, self).__init__(*args, **kwargs)
@@ -96,5 +186,289 @@ class Error(Failure):
 
 
 class Skipped(Result):
+    __slots__ = ()
+    status_code = SKIPPED
+
     def __str__(self):
         return "SKIPPED"
+
+
+RESULT_CLASSES = dict((cls.__name__, cls)
+                      for cls in (Result, Success, Failure, Error, Skipped))
+
+
+def from_dict(data):
+    """Rebuild a result from the output of its to_dict method."""
+    cls = RESULT_CLASSES.get(data.get('result'), Result)
+    slots = set(cls._slots())
+    state = {}
+    extra = {}
+    for k, v in data.items():
+        if k in ('result', 'duration', 'wall_time'):
+            continue
+        if k in slots:
+            state[k] = v
+        else:
+            extra[k] = v
+    # Results whose duration field means something else keep the time
+    # they took in wall_time.
+    state['_duration'] = float(data.get('wall_time',
+                                        data.get('duration')) or 0)
+    if extra:
+        state['extra'] = extra
+    result = cls.__new__(cls)
+    result.__setstate__(state)
+    return result
+
+
+class _Values(object):
+    """A list of distinct values, each stored once and found by index."""
+
+    def __init__(self):
+        self.values = []
+        self._index = {}
+
+    def find(self, value):
+        return self._index.get(value)
+
+    def index(self, value):
+        try:
+            return self._index[value]
+        except KeyError:
+            self._index[value] = len(self.values)
+            self.values.append(value)
+            return self._index[value]
+
+
+class ResultDict(object):
+    """Results kept as objects in a dict of dicts."""
+
+    def __init__(self):
+        self._results = {}
+
+    def __len__(self):
+        return sum(len(results) for results in self._results.values())
+
+    def get(self, test_name, host, server):
+        return self._results.get(test_name, {}).get((host, server))
+
+    def set(self, test_name, host, server, result):
+        self._results.setdefault(test_name, {})[(host, server)] = result
+
+    def tests(self):
+        return list(self._results)
+
+    def snapshot(self):
+        return dict((test, dict(results))
+                    for test, results in self._results.items())
+
+    def items(self):
+        return [(test, host, server, result)
+                for test, results in self._results.items()
+                for (host, server), result in results.items()]
+
+
+class ResultTable(object):
+    """Results kept in columns for large runs.
+
+    Test names, hosts, servers, result classes and reasons are each
+    stored once, and every result is a row of small integers and a float
+    duration in arrays.  Anything else a result carries (exceptions,
+    tracebacks, extras) is only stored for the rows that have it.
+    Result objects are rebuilt when they are read back.
+
+    When max_extra_length is set, long strings in a result's extras such
+    as console output are cut down to their last max_extra_length
+    characters, and a message is logged each time.
+    """
+
+    def __init__(self, max_extra_length=None):
+        self.max_extra_length = max_extra_length
+        self._tests = _Values()
+        self._hosts = _Values()
+        self._servers = _Values()
+        self._classes = _Values()
+        self._reasons = _Values()
+        self._rows = {}
+        self._test_ids = array('i')
+        self._host_ids = array('i')
+        self._server_ids = array('i')
+        self._class_ids = array('i')
+        self._codes = array('b')
+        self._durations = array('d')
+        self._reason_ids = array('i')
+        self._details = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _truncate(self, test_name, host, server, extra):
+        truncated = dict(extra)
+        for k, v in extra.items():
+            if (isinstance(v, six.string_types) and
+                    len(v) > self.max_extra_length):
+                LOG.info("Keeping the last %s of %s characters of %s for "
+                         "%s on %s (%s)", self.max_extra_length, len(v), k,
+                         test_name, host, server)
+                truncated[k] = v[-self.max_extra_length:]
+        return truncated
+
+    def get(self, test_name, host, server):
+        row = self._rows.get((self._tests.find(test_name),
+                              self._hosts.find(host),
+                              self._servers.find(server)))
+        if row is None:
+            return None
+        return self._result(row)
+
+    def set(self, test_name, host, server, result):
+        key = (self._tests.index(test_name),
+               self._hosts.index(host),
+               self._servers.index(server))
+        state = result.__getstate__()
+        duration = state.pop('_duration', 0.0)
+        reason = state.pop('reason', None)
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = len(self._codes)
+            self._test_ids.append(key[0])
+            self._host_ids.append(key[1])
+            self._server_ids.append(key[2])
+            self._class_ids.append(0)
+            self._codes.append(0)
+            self._durations.append(0.0)
+            self._reason_ids.append(-1)
+        self._class_ids[row] = self._classes.index(result.__class__)
+        self._codes[row] = result.status_code
+        self._durations[row] = duration
+        self._reason_ids[row] = (-1 if reason is None
+                                 else self._reasons.index(reason))
+        if self.max_extra_length and state.get('extra'):
+            state['extra'] = self._truncate(test_name, host, server,
+                                            state['extra'])
+        if state:
+            self._details[row] = state
+        else:
+            self._details.pop(row, None)
+
+    def _result(self, row):
+        cls = self._classes.values[self._class_ids[row]]
+        state = dict(self._details.get(row, {}))
+        state['_duration'] = self._durations[row]
+        if self._reason_ids[row] >= 0:
+            state['reason'] = self._reasons.values[self._reason_ids[row]]
+        result = cls.__new__(cls)
+        result.__setstate__(state)
+        return result
+
+    def tests(self):
+        return list(self._tests.values)
+
+    def items(self):
+        return [(self._tests.values[self._test_ids[row]],
+                 self._hosts.values[self._host_ids[row]],
+                 self._servers.values[self._server_ids[row]],
+                 self._result(row))
+                for row in range(len(self._codes))]
+
+    def snapshot(self):
+        results = {}
+        for test, host, server, result in self.items():
+            results.setdefault(test, {})[(host, server)] = result
+        return results
+
+    def counts(self):
+        """Count the results by test name and status code."""
+        counts = Counter()
+        for row in range(len(self._codes)):
+            counts[(self._tests.values[self._test_ids[row]],
+                    self._codes[row])] += 1
+        return counts
+
+
+class ResultStore(object):
+    """Thread-safe store of test results.
+
+    Results are keyed by test name and (host, server).  Many threads may
+    add results while others report on them, so every read returns a
+    consistent copy taken under the lock.  Writes only touch a few dicts
+    so a single lock is held very briefly.  Indexes of failed and passed
+    servers and of the servers tested on each host are kept up to date as
+    results are added.
+
+    With compact set the results are kept in a :class:`ResultTable`,
+    which keeps only the end of extras longer than max_extra_length.
+    """
+
+    def __init__(self, compact=False, max_extra_length=None):
+        self._lock = threading.Lock()
+        self._results = (ResultTable(max_extra_length) if compact
+                         else ResultDict())
+        self._failed_servers = defaultdict(set)
+        self._passed_servers = defaultdict(set)
+        self._failure_counts = Counter()
+        self._host_servers = defaultdict(set)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+    def add(self, test_name, host, server, result):
+        with self._lock:
+            previous = self._results.get(test_name, host, server)
+            if previous is not None:
+                self._unindex(test_name, server, previous)
+            self._results.set(test_name, host, server, result)
+            self._index(test_name, host, server, result)
+
+    def _index(self, test_name, host, server, result):
+        self._host_servers[host].add(server)
+        if result.is_failure():
+            self._failed_servers[test_name].add(server)
+            self._failure_counts[server] += 1
+        elif not isinstance(result, Skipped):
+            self._passed_servers[test_name].add(server)
+
+    def _unindex(self, test_name, server, result):
+        if result.is_failure():
+            self._failed_servers[test_name].discard(server)
+            self._failure_counts[server] -= 1
+            if not self._failure_counts[server]:
+                del self._failure_counts[server]
+        else:
+            self._passed_servers[test_name].discard(server)
+
+    def get(self, test_name, host, server):
+        with self._lock:
+            return self._results.get(test_name, host, server)
+
+    def tests(self):
+        with self._lock:
+            return self._results.tests()
+
+    def snapshot(self):
+        """Return a copy of the results as {test: {(host, server): result}}.
+        """
+        with self._lock:
+            return self._results.snapshot()
+
+    def items(self):
+        """Return a list of (test, host, server, result) tuples."""
+        with self._lock:
+            return self._results.items()
+
+    def failed_servers(self, test_name):
+        with self._lock:
+            return set(self._failed_servers.get(test_name, ()))
+
+    def passed_servers(self, test_name):
+        with self._lock:
+            return set(self._passed_servers.get(test_name, ()))
+
+    def has_failures(self, server):
+        with self._lock:
+            return server in self._failure_counts
+
+    def servers_on_host(self, host):
+        with self._lock:
+            return set(self._host_servers.get(host, ()))
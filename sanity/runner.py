@@ -17,10 +17,10 @@
 import logging
 
 import six
-from novaclient import client as no_client
 
 from sanity import fixtures
 from sanity import os_sdk
+from sanity.util import background
 
 LOG = logging.getLogger(__name__)
 
@@ -36,16 +36,21 @@ class Runner(object):
                  password,
                  endpoint_type,
                  state,
-                 tests=[]):
+                 tests=[],
+                 connections=None,
+                 concurrent=True):
         self._test_results = {}
-        clientmanager = os_sdk.create_connection(
+        self.concurrent = concurrent
+        if connections is None:
+            connections = os_sdk.connections
+        self._connections = connections
+        self._clients = self._connections.acquire(
             auth_url, tenant, username, password,
             endpoint_type=endpoint_type)
-        self.keystone = clientmanager.identity
-        self.nova = no_client.Client(
-            '2', session=clientmanager.session)
-        self.neutron = clientmanager.network
-        self.glance = clientmanager.image
+        self.keystone = self._clients.keystone
+        self.nova = self._clients.nova
+        self.neutron = self._clients.neutron
+        self.glance = self._clients.glance
         self._state = state
         self.tests = []
         self.fixtures = {}
@@ -55,6 +60,12 @@ class Runner(object):
                      self.neutron, self.glance,
                      self._state))
 
+    def close(self):
+        """Release the shared connection."""
+        if self._clients is not None:
+            self._connections.release(self._clients)
+            self._clients = None
+
     def update_state(self, state):
         assert state, "Tried to update with an empty state."
         self._state = state
@@ -94,35 +105,64 @@ class Runner(object):
                     return result
 
     def run_server(self, sanity, server):
+        """Run every scenario against a server.
+
+        Scenarios that are concurrent and use no fixtures run together
+        in the background.  The rest run one after another once those
+        have finished, as they may need the guest to have finished
+        booting, which the console log scenario waits for.
+        """
         current_host = (getattr(server, 'OS-EXT-SRV-ATTR:host') or
                         server.metadata['host_id'])
         self.setUpFixtures()
+        running = []
+        serial = []
         for test in self.tests:
+            if self.concurrent and self.is_concurrent(test):
+                running.append((test, background(
+                    self._run_scenario, sanity, test, server, current_host)))
+            else:
+                serial.append(test)
 
-            result = test.setUp()
-            if result.is_failure():
-                sanity.add_test_result(test.name, current_host,
-                                       server.id, result)
-                self.maybe_log_failure(server, result)
-                continue
-
-            LOG.info('Running %s: %s' % (test.name, server.id))
+        for test, wait in running:
             try:
-                self._run_test(sanity, test, server)
-            except Exception as e:
-                LOG.exception(e)
+                wait()
+            except Exception:
+                LOG.exception("%s failed on server %s", test.name, server.id)
+
+        for test in serial:
+            self._run_scenario(sanity, test, server, current_host)
+
+    @staticmethod
+    def is_concurrent(test):
+        return (test.concurrent and
+                not fixtures.getFixtures(test.test_server))
 
-            result = test.tearDown()
+    def _run_scenario(self, sanity, test, server, current_host):
+        result = test.setUp()
+        if result.is_failure():
+            sanity.add_test_result(test.name, current_host,
+                                   server.id, result)
+            self.maybe_log_failure(server, result)
+            return
+
+        LOG.info('Running %s: %s' % (test.name, server.id))
+        try:
+            self._run_test(sanity, test, server)
+        except Exception as e:
+            LOG.exception(e)
+
+        result = test.tearDown()
+        if result.is_failure():
+            sanity.add_test_result(test.name, current_host,
+                                   server.id, result)
+            self.maybe_log_failure(server, result)
+            return
+
+        for fixture in fixtures.getFixtures(test.test_server):
+            result = self.fixtures[fixture].disableFixture(server)
             if result.is_failure():
-                sanity.add_test_result(test.name, current_host,
-                                       server.id, result)
                 self.maybe_log_failure(server, result)
-                continue
-
-            for fixture in fixtures.getFixtures(test.test_server):
-                result = self.fixtures[fixture].disableFixture(server)
-                if result.is_failure():
-                    self.maybe_log_failure(server, result)
 
     def cleanup(self):
         for fixture in self.fixtures.values():
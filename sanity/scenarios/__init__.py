@@ -40,26 +40,23 @@ def has_booted(server):
     return not isinstance(server, UnbootableServer)
 
 
-class Success(results.Result):
-    def __init__(self, *args, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, k, v)
-
-    def __str__(self):
-        seconds = self.duration.seconds
-        return ('PASS {:02}:{:02}'.format(
-            seconds % 3600 // 60, seconds % 60))
+class Success(results.Success):
+    __slots__ = ()
 
-    def to_dict(self):
-        return {
-            'result': self.__class__.__name__,
-            'duration': self.duration.seconds,
-        }
+    def __init__(self, *args, **kwargs):
+        super(Success, self).__init__(**kwargs)
 
 
 class SanityScenario(object):
     name = None
     log = LOG
+    # Extra security group rules the scenario needs, in the form
+    # accepted by create_security_group_rule.
+    security_group_rules = []
+    # Whether the scenario can run against a server at the same time as
+    # the other concurrent scenarios.  The rest, and any that use
+    # fixtures, run one at a time after the concurrent ones finish.
+    concurrent = False
 
     def __init__(self, keystone, nova, neutron, glance, state):
         self.keystone = keystone
@@ -171,3 +168,11 @@ def get_enabled_tests(tests=[]):
                              % (test, list(TESTS.keys())))
         test_classes.append(TESTS[test])
     return test_classes
+
+
+def get_security_group_rules(tests=[]):
+    """The extra security group rules the enabled tests need."""
+    rules = []
+    for test_class in get_enabled_tests(tests):
+        rules.extend(test_class.security_group_rules)
+    return rules
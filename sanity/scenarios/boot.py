@@ -20,6 +20,7 @@ from oslo_config import cfg
 
 from sanity.scenarios import (Success, Failure,
                               SanityScenario, has_booted)
+from sanity.watcher import has_timed_out
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
@@ -29,6 +30,7 @@ class BootScenario(SanityScenario):
     name = 'Boot Check'
     shortname = 'boot'
     log = LOG
+    concurrent = True
 
     def setUp(self):
         result = super(BootScenario, self).setUp()
@@ -40,6 +42,10 @@ class BootScenario(SanityScenario):
                 "Server didn't boot, %s" % server.status)
 
         if server.status == 'ACTIVE':
+            if has_timed_out(server):
+                return Failure(
+                    "Timed out waiting for the %s task to finish."
+                    % getattr(server, 'OS-EXT-STS:task_state', None))
             return Success()
         if not getattr(server, 'OS-EXT-SRV-ATTR:host'):
             return Failure(
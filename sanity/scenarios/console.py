@@ -8,7 +8,11 @@ LOG = logging.getLogger(__name__)
 
 
 class CloudInitSuccess(Success):
-    boot_time = None
+    __slots__ = ('boot_time',)
+
+    def __init__(self, boot_time=None, **kwargs):
+        self.boot_time = boot_time
+        super(CloudInitSuccess, self).__init__(**kwargs)
 
     def __str__(self):
         seconds = self.duration.seconds
@@ -16,9 +20,13 @@ class CloudInitSuccess(Success):
                 ' {:02}:{:02}'.format(seconds % 3600 // 60, seconds % 60))
 
     def to_dict(self):
+        # duration has always been the boot time in the JSON output, the
+        # time the check took is kept alongside it.
         return {
             'result': 'Success',
             'duration': int(float(self.boot_time)),
+            'boot_time': self.boot_time,
+            'wall_time': self.duration.seconds,
         }
 
 
@@ -26,6 +34,7 @@ class ConsoleScenario(SanityScenario):
     name = 'Console Log Check'
     shortname = 'console-log'
     log = LOG
+    concurrent = True
     success_re = re.compile(r'Cloud-init v\. \S+ finished '
                             r'at .* Up ([\d.]+) seconds')
     failure_res = [
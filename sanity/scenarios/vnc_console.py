@@ -12,6 +12,7 @@ class VNCConsoleScenario(SanityScenario):
     name = 'VNC Console Check'
     shortname = 'vnc-console'
     log = LOG
+    concurrent = True
 
     def _test_server(self, server):
         if server.status != 'ACTIVE':
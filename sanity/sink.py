@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+LOG = logging.getLogger(__name__)
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class ResultSink(object):
+    """Append test results to a file as JSON lines as they are recorded.
+
+    Each result is written as soon as it is added, so a run that is
+    killed part way through still leaves every finished result on disk.
+    Uncompressed streams are flushed after every line.  Compressed
+    streams (filenames ending in .gz) are flushed when they are synced,
+    as flushing gzip after every line would undo most of the compression.
+    The file is fsynced at most every fsync_interval seconds, 0 syncs
+    after every line and None never does.
+
+    The file is appended to, so a re-run can add to an existing stream.
+    """
+
+    def __init__(self, filename, compress=None, fsync_interval=5):
+        if compress is None:
+            compress = filename.endswith('.gz')
+        self.filename = filename
+        self.compress = compress
+        self.fsync_interval = fsync_interval
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(filename, 'ab')
+        if compress:
+            self._stream = gzip.GzipFile(fileobj=self._file, mode='ab')
+        else:
+            self._stream = self._file
+        self._synced_at = time.time()
+        self._closed = False
+
+    def write(self, test_name, host, server, result):
+        self._write({
+            'time': datetime.utcnow().isoformat(),
+            'test': test_name,
+            'host': host,
+            'server': server,
+            'result': result.to_dict(),
+        })
+
+    def write_snapshot(self, snapshot):
+        """Record the hosts and aggregates the run started with."""
+        self._write({
+            'time': datetime.utcnow().isoformat(),
+            'snapshot': snapshot,
+        })
+
+    def _write(self, record):
+        line = json.dumps(record) + '\n'
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        with self._lock:
+            if self._closed:
+                return
+            self._stream.write(line)
+            self.count += 1
+            if not self.compress:
+                self._stream.flush()
+            if (self.fsync_interval is not None and
+                    time.time() - self._synced_at >= self.fsync_interval):
+                self._sync()
+
+    def _sync(self):
+        self._stream.flush()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced_at = time.time()
+
+    def sync(self):
+        with self._lock:
+            if not self._closed:
+                self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self.compress:
+                self._stream.close()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
+def _open(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def read_results(filename):
+    """Read the records back from a result stream.
+
+    Streams from runs that were killed may end with a partial line or an
+    unfinished gzip member, everything before that is still returned.
+    """
+    with _open(filename) as f:
+        lineno = 0
+        while True:
+            try:
+                line = f.readline()
+            except (IOError, EOFError, zlib.error) as e:
+                LOG.warning("%s is truncated after line %s: %s",
+                            filename, lineno, e)
+                return
+            if not line:
+                return
+            lineno += 1
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                LOG.warning("Skipping unreadable line %s of %s",
+                            lineno, filename)
+
+
+def fold_results(records):
+    """Fold result records into the shape of the JSON report.
+
+    Returns {test: [(host, server, result), ...]}, later records for the
+    same test, host and server replace earlier ones.
+    """
+    tests = OrderedDict()
+    for record in records:
+        if 'test' not in record:
+            continue
+        results = tests.setdefault(record['test'], OrderedDict())
+        results[(record['host'], record['server'])] = record['result']
+    return dict((test, [(host, server, result)
+                        for (host, server), result in results.items()])
+                for test, results in tests.items())
+
+
+def find_snapshot(records):
+    """Return the last host snapshot in the records, if there is one."""
+    snapshot = None
+    for record in records:
+        if 'snapshot' in record:
+            snapshot = record['snapshot']
+    return snapshot
@@ -18,6 +18,7 @@ from unittest import TestCase
 import mock
 
 from sanity.scenarios import BootScenario, Success, Failure, UnbootableServer
+from sanity import watcher
 
 
 class TestBootScenario(TestCase):
@@ -38,6 +39,14 @@ class TestBootScenario(TestCase):
         result = self.scenario.test_server(server)
         self.assertTrue(isinstance(result, Success))
 
+    def test_timed_out_active_server(self):
+        server = mock.Mock()
+        server.status = 'ACTIVE'
+        setattr(server, 'OS-EXT-STS:task_state', 'rebooting')
+        watcher.mark_timed_out(server)
+        result = self.scenario.test_server(server)
+        self.assertTrue(isinstance(result, Failure))
+
     def test_failed_scheduled_server(self):
         server = mock.MagicMock()
         server.status = 'ERRRR'
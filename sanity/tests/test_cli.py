@@ -14,12 +14,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from datetime import datetime, timedelta
 from unittest import TestCase
 import Queue
+import threading
+import time
+
 import mock
 
 from sanity import cli
+from sanity import os_sdk
 from sanity import scenarios
+from sanity import watcher
 
 
 class AttrDict(dict):
@@ -64,6 +70,18 @@ class TestTesterThread(TestCase):
         tester.finish()
         tester()
 
+    @mock.patch('sanity.runner.Runner')
+    @mock.patch('sanity.cli.CONF', new_callable=AttrDict)
+    def test_connection_released(self, cli_conf, mock_runner):
+        self.setup_conf(cli_conf,
+                        no_delete_failed=False, no_delete=False, test=[])
+        tester = self.setup_tester()
+        mock_runner().cleanup.side_effect = Exception('cleanup failed')
+        tester.finish()
+        with self.assertRaises(Exception):
+            tester()
+        mock_runner().close.assert_called_once_with()
+
     @mock.patch('sanity.runner.Runner')
     @mock.patch('sanity.cli.CONF', new_callable=AttrDict)
     def test_processing_a_host(self, cli_conf, mock_runner):
@@ -78,7 +96,8 @@ class TestTesterThread(TestCase):
         self.assertAllProcessed()
         self.assertEqual(mock_runner().method_calls,
                          [mock.call.run_server(self.insanity, server),
-                          mock.call.cleanup()])
+                          mock.call.cleanup(),
+                          mock.call.close()])
         self.assertEqual(server.mock_calls,
                          [mock.call.delete()])
         self.assertEqual(self.insanity.mock_calls,
@@ -98,7 +117,28 @@ class TestTesterThread(TestCase):
         self.assertAllProcessed()
         self.assertEqual(mock_runner().method_calls,
                          [mock.call.run_server(self.insanity, server),
-                          mock.call.cleanup()])
+                          mock.call.cleanup(),
+                          mock.call.close()])
+        self.assertEqual(self.insanity.mock_calls, [])
+
+    @mock.patch('sanity.runner.Runner')
+    @mock.patch('sanity.cli.CONF', new_callable=AttrDict)
+    def test_processing_a_timed_out_server(self, cli_conf, mock_runner):
+        self.setup_conf(cli_conf,
+                        no_delete_failed=False, no_delete=False, test=[])
+        tester = self.setup_tester()
+        server = mock.Mock(status='BUILD')
+        watcher.mark_timed_out(server)
+        self.in_queue.put(server)
+        tester.finish()
+        tester()
+        self.assertEqual(self.out_queue.get_nowait(), server)
+        self.assertAllProcessed()
+        self.assertEqual(mock_runner().method_calls,
+                         [mock.call.run_server(self.insanity, server),
+                          mock.call.cleanup(),
+                          mock.call.close()])
+        # It isn't waited on a second time
         self.assertEqual(self.insanity.mock_calls, [])
 
     @mock.patch('sanity.runner.Runner')
@@ -117,7 +157,7 @@ class TestTesterThread(TestCase):
         self.assertAllProcessed()
         server.delete.assert_called_once_with()
         self.assertEqual(mock_runner().method_calls,
-                         [mock.call.cleanup()])
+                         [mock.call.cleanup(), mock.call.close()])
         self.assertEqual(self.insanity.mock_calls, [])
 
     @mock.patch('sanity.runner.Runner')
@@ -134,7 +174,7 @@ class TestTesterThread(TestCase):
         self.assertAllProcessed()
         server.delete.assert_called_once_with()
         self.assertEqual(mock_runner().method_calls,
-                         [mock.call.cleanup()])
+                         [mock.call.cleanup(), mock.call.close()])
         self.assertEqual(self.insanity.mock_calls, [])
 
     @mock.patch('sanity.runner.Runner')
@@ -153,7 +193,7 @@ class TestTesterThread(TestCase):
         server = self.out_queue.get_nowait()
         self.assertAllProcessed()
         self.assertEqual(mock_runner().method_calls,
-                         [mock.call.cleanup()])
+                         [mock.call.cleanup(), mock.call.close()])
         self.assertEqual(self.insanity.mock_calls, [])
 
     @mock.patch('sanity.runner.Runner')
@@ -174,7 +214,8 @@ class TestTesterThread(TestCase):
         self.assertAllProcessed()
         self.assertEqual(mock_runner().method_calls,
                          [mock.call.run_server(self.insanity, server),
-                          mock.call.cleanup()])
+                          mock.call.cleanup(),
+                          mock.call.close()])
         self.assertEqual(self.insanity.mock_calls,
                          [mock.call.wait_for_servers([server])])
 
@@ -264,3 +305,124 @@ class TestFixturerThread(TestCase):
         tester = self.setup_tester()
         tester.initialize()
         self.assertEqual(tester.compromised, False)
+
+
+class TestWaiterThread(TestCase):
+
+    def setUp(self):
+        self.in_queue = Queue.Queue()
+        self.out_queue = Queue.Queue()
+        self.insanity = mock.Mock()
+        self.futures = {}
+
+        def watch_server(server):
+            future = watcher.ServerFuture(server, ('ACTIVE',), 60)
+            self.futures[server.id] = future
+            return future
+        self.insanity.watch_server.side_effect = watch_server
+        self.waiter = cli.ThreadedWaiter(self.in_queue, self.out_queue,
+                                         self.insanity)
+
+    def test_servers_passed_on_in_finishing_order(self):
+        slow, fast = mock.Mock(id='slow'), mock.Mock(id='fast')
+        unbootable = scenarios.UnbootableServer()
+        for server in [slow, fast, unbootable]:
+            self.in_queue.put(server)
+        self.waiter.finish()
+        thread = threading.Thread(target=self.waiter)
+        thread.daemon = True
+        thread.start()
+
+        self.assertEqual(self.out_queue.get(timeout=5), unbootable)
+        while len(self.futures) < 2:
+            time.sleep(0.01)
+        self.futures['fast'].set_result(fast)
+        self.assertEqual(self.out_queue.get(timeout=5), fast)
+        self.futures['slow'].set_result(slow)
+        self.assertEqual(self.out_queue.get(timeout=5), slow)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_timed_out_servers_marked(self):
+        server = mock.Mock(id='stuck', status='BUILD')
+        self.in_queue.put(server)
+        self.waiter.finish()
+        thread = threading.Thread(target=self.waiter)
+        thread.daemon = True
+        thread.start()
+
+        while not self.futures:
+            time.sleep(0.01)
+        self.futures['stuck'].set_exception(watcher.ServerTimeout('stuck'))
+        ready = self.out_queue.get(timeout=5)
+        self.assertEqual(ready, server)
+        self.assertTrue(watcher.has_timed_out(ready))
+        thread.join(5)
+
+    def test_ready_servers_count_towards_max_pending(self):
+        self.waiter.max_pending = 2
+        servers = [mock.Mock(id='server-%s' % i) for i in range(3)]
+        for server in servers:
+            self.in_queue.put(server)
+        thread = threading.Thread(target=self.waiter)
+        thread.daemon = True
+        thread.start()
+
+        while len(self.futures) < 2:
+            time.sleep(0.01)
+        self.futures['server-0'].set_result(servers[0])
+        self.futures['server-1'].set_result(servers[1])
+        # Both are ready but untested, so the third isn't taken yet
+        time.sleep(0.3)
+        self.assertEqual(len(self.futures), 2)
+        self.assertEqual(self.in_queue.qsize(), 1)
+
+        self.out_queue.get(timeout=5)
+        while len(self.futures) < 3:
+            time.sleep(0.01)
+        self.waiter.stop()
+        thread.join(5)
+
+
+class TestMainBase(TestCase):
+
+    def test_token_refresher_does_not_hold_up_the_run(self):
+        auth = os_sdk.Password(auth_url='http://keystone:5000/v2.0',
+                               username='user', password='secret',
+                               project_name='project')
+        auth.refresh_before = 300
+        expires = datetime.now() + timedelta(hours=1)
+        auth._schedule_refresh(mock.Mock(), mock.Mock(expires=expires))
+        self.addCleanup(auth.stop_refresh)
+
+        main = cli.MainBase()
+        main.waiter = mock.Mock()
+        finished = threading.Event()
+        tester = mock.Mock()
+        tester.finish.side_effect = finished.set
+        main.thread_controllers = [tester]
+        booter = threading.Thread(target=time.sleep, args=(0.2,))
+        booter.setName('ThreadedBooter-1')
+        testing = threading.Thread(target=finished.wait)
+        testing.setName('Tester-2')
+        testing.daemon = True
+        main.threads = [booter, testing]
+        completed = Queue.Queue()
+        servers = [mock.Mock(id='server-%s' % i) for i in range(3)]
+        for server in servers:
+            completed.put(server)
+        booter.start()
+        testing.start()
+
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(main.wait_for_threads(completed)))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIn('TokenRefresh',
+                      [t.getName() for t in threading.enumerate()])
+        self.assertEqual(result, [servers])
+        self.assertTrue(main.waiter.finish.called)
+        self.assertTrue(tester.finish.called)
@@ -15,6 +15,13 @@
 #    under the License.
 
 from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+import time
+from functools import partial
+
 import mock
 
 from openstack.image.v1 import image
@@ -22,6 +29,8 @@ from openstack.network.v2 import security_group
 from openstack.network.v2 import security_group_rule
 
 from sanity import controller
+from sanity import watcher
+from sanity import results
 
 
 class TestSanityState(TestCase):
@@ -89,6 +98,46 @@ class TestSanityState(TestCase):
                          'qaspansecg-1234')
 
 
+class TestSecurityGroupRules(TestCase):
+
+    def setUp(self):
+        self.neutron = mock.Mock()
+        self.state = controller.SanityState(
+            mock.Mock(), mock.Mock(), mock.Mock(), self.neutron)
+        self.state._SanityState__security_group = {'id': 'sg-1'}
+
+    def test_only_missing_rules_created(self):
+        self.neutron.security_group_rules.return_value = [
+            security_group_rule.SecurityGroupRule(
+                {'direction': 'ingress', 'ethertype': 'IPv4',
+                 'protocol': 'ICMP', 'security_group_id': 'sg-1'})]
+        self.state.create_security_group_rules()
+        self.neutron.security_group_rules.assert_called_once_with(
+            security_group_id='sg-1')
+        self.neutron.create_security_group_rule.assert_called_once_with(
+            direction='ingress', port_range_min=22, port_range_max=22,
+            protocol='tcp', ethertype='IPv4', remote_ip_prefix='0.0.0.0/0',
+            security_group_id='sg-1')
+
+    def test_nothing_to_create(self):
+        self.neutron.security_group_rules.return_value = [
+            dict(rule, id=str(i)) for i, rule
+            in enumerate(controller.SECURITY_GROUP_RULES)]
+        self.state.create_security_group_rules()
+        self.assertFalse(self.neutron.create_security_group_rule.called)
+
+    def test_scenario_rules(self):
+        http = {'direction': 'ingress', 'protocol': 'tcp',
+                'port_range_min': 80, 'port_range_max': 80}
+        self.state.add_security_group_rules(
+            [http, dict(http), controller.SECURITY_GROUP_RULES[0]])
+        self.assertEqual(len(self.state.security_group_rules), 3)
+        self.neutron.security_group_rules.return_value = []
+        self.state.create_security_group_rules()
+        self.assertEqual(
+            self.neutron.create_security_group_rule.call_count, 3)
+
+
 class UnitTestSanityState(TestCase):
 
     def setUp(self):
@@ -138,3 +187,377 @@ class UnitTestSanityState(TestCase):
 
         with self.assertRaises(self.controller.ImageNotFound):
             self.controller.image
+
+    def test_get_flavor_lists_once(self):
+        flavors = [mock.Mock(id='1'), mock.Mock(id='2')]
+        flavors[0].name = 'Micro-Small'
+        flavors[1].name = 'GP-Small'
+        self.nova.flavors.list.return_value = flavors
+
+        self.assertIs(self.controller._get_flavor('Missing', 'GP-Small'),
+                      flavors[1])
+        self.assertIs(self.controller._get_flavor('1'), flavors[0])
+        self.assertEqual(self.nova.flavors.list.call_count, 2)
+        with self.assertRaises(Exception):
+            self.controller._get_flavor('Missing', 'Other')
+
+
+class TestSanityStateTearDown(TestCase):
+
+    def setUp(self):
+        self.state = controller.SanityState(
+            mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock())
+        self.order = []
+        for name in ['keypair', 'subnet', 'router', 'network',
+                     'floatingip', 'security_group']:
+            setattr(self.state, 'clean_' + name,
+                    mock.Mock(side_effect=partial(self.order.append, name)))
+
+    def test_subnet_first(self):
+        self.state.tearDown()
+        self.assertEqual(len(self.order), 6)
+        for name in ['router', 'network', 'security_group']:
+            self.assertLess(self.order.index('subnet'),
+                            self.order.index(name))
+
+    def test_delete_floating_ips(self):
+        state = controller.SanityState(
+            mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock())
+        state.neutron.ips.return_value = [
+            {'id': 'ip-1', 'port_id': None},
+            {'id': 'ip-2', 'port_id': 'port-1'},
+            {'id': 'ip-3', 'port_id': None}]
+        state.clean_floatingip()
+        self.assertEqual(
+            sorted(c[0][0] for c in state.neutron.delete_ip.call_args_list),
+            ['ip-1', 'ip-3'])
+
+
+class TestStateCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, 'state.json')
+        controller.CONF.set_override('state_cache', self.filename)
+        self.addCleanup(controller.CONF.clear_override, 'state_cache')
+
+        self.keystone = mock.Mock()
+        self.keystone.session.auth.auth_url = 'https://keystone:5000/v3'
+        self.keystone.session.get_project_id.return_value = 'project-1'
+        self.glance = mock.Mock()
+        self.neutron = mock.Mock()
+        self.state = controller.SanityState(
+            self.keystone, mock.Mock(), self.glance, self.neutron)
+
+    def test_round_trip(self):
+        cache = controller.StateCache(self.filename)
+        cache.save('cloud-1', {'image': {'id': 'i-1', 'config': 're'}})
+        cache.save('cloud-2', {})
+        self.assertEqual(cache.load('cloud-1'),
+                         {'image': {'id': 'i-1', 'config': 're'}})
+        self.assertEqual(cache.load('cloud-3'), {})
+
+    def test_use_cached(self):
+        self.glance.get_image.return_value = image.Image(
+            {'id': 'i-1', 'name': 'RHEL-7', 'status': 'active'})
+        self.state._use_cached('image', self.state._image_name_re,
+                               {'id': 'i-1',
+                                'config': self.state._image_name_re})
+        self.assertEqual(self.state.image.id, 'i-1')
+        self.assertFalse(self.glance.images.called)
+
+    def test_stale_or_changed_entries_ignored(self):
+        self.glance.get_image.side_effect = Exception('Not Found')
+        self.state._use_cached('image', self.state._image_name_re,
+                               {'id': 'i-1',
+                                'config': self.state._image_name_re})
+        self.state._use_cached('router', 'new-router',
+                               {'id': 'r-1', 'config': 'old-router'})
+        self.assertFalse(self.neutron.get_router.called)
+        self.assertEqual(self.state._SanityState__image, {})
+        self.assertEqual(self.state._SanityState__router, {})
+
+    def test_save_and_load(self):
+        configs = {'image': 're', 'router': 'router'}
+        self.state._SanityState__image = mock.Mock(id='i-1')
+        self.state._SanityState__router = mock.Mock(id='r-1')
+        self.state._save_cache(configs)
+        with open(self.filename) as f:
+            self.assertEqual(list(json.load(f)),
+                             ['https://keystone:5000/v3 project-1'])
+        self.assertEqual(self.state._load_cache(),
+                         {'image': {'id': 'i-1', 'config': 're'},
+                          'router': {'id': 'r-1', 'config': 'router'}})
+
+
+class TestServerIndex(TestCase):
+
+    def make_server(self, uuid, status='ACTIVE',
+                    updated='2016-01-01T00:00:10Z'):
+        server = mock.Mock()
+        server.id = uuid
+        server.status = status
+        server.created = '2016-01-01T00:00:00Z'
+        server.updated = updated
+        return server
+
+    def list_servers(self, detailed, search_opts):
+        if 'marker' in search_opts:
+            return []
+        return self.pages.pop(0)
+
+    def setUp(self):
+        self.nova = mock.Mock()
+        self.nova.servers.list.side_effect = self.list_servers
+        self.index = controller.ServerIndex(self.nova)
+
+    def test_refresh_merges_changes(self):
+        self.pages = [
+            [self.make_server('1'), self.make_server('2')],
+            [self.make_server('2', 'DELETED', '2016-01-01T00:01:00Z'),
+             self.make_server('3', 'BUILD', '2016-01-01T00:01:00Z')]]
+
+        servers = self.index.refresh()
+        self.assertEqual(sorted(s.id for s in servers), ['1', '2'])
+        self.assertEqual(self.nova.servers.list.call_args_list[0],
+                         mock.call(detailed=True, search_opts={}))
+
+        self.nova.servers.list.reset_mock()
+        servers = self.index.refresh()
+        self.assertEqual(sorted(s.id for s in servers), ['1', '3'])
+        self.assertEqual(
+            self.nova.servers.list.call_args_list[0],
+            mock.call(detailed=True,
+                      search_opts={'changes-since': '2016-01-01T00:00:08Z'}))
+
+    def test_reset(self):
+        self.pages = [[self.make_server('1')], []]
+        self.index.refresh()
+        self.index.reset()
+        self.nova.servers.list.reset_mock()
+        self.assertEqual(self.index.refresh(), [])
+        self.assertEqual(self.nova.servers.list.call_args_list[0],
+                         mock.call(detailed=True, search_opts={}))
+
+
+class TestIterServers(TestCase):
+
+    def setUp(self):
+        self.pages = {None: [mock.Mock(id='1'), mock.Mock(id='2')],
+                      '2': [mock.Mock(id='3')],
+                      '3': []}
+        self.nova = mock.Mock()
+        self.nova.servers.list.side_effect = \
+            lambda detailed, search_opts: \
+            self.pages[search_opts.get('marker')]
+
+    def test_all_pages(self):
+        for prefetch in (True, False):
+            servers = controller.iter_servers(self.nova, page_size=2,
+                                              prefetch=prefetch)
+            self.assertEqual([s.id for s in servers], ['1', '2', '3'])
+        self.assertEqual(self.nova.servers.list.call_args_list[:3],
+                         [mock.call(detailed=True,
+                                    search_opts={'limit': 2}),
+                          mock.call(detailed=True,
+                                    search_opts={'limit': 2, 'marker': '2'}),
+                          mock.call(detailed=True,
+                                    search_opts={'limit': 2, 'marker': '3'})])
+
+    def test_limit(self):
+        servers = controller.list_servers(self.nova, limit=2)
+        self.assertEqual([s.id for s in servers], ['1', '2'])
+        self.assertEqual(self.nova.servers.list.call_count, 1)
+
+    def test_stop_early(self):
+        for prefetch in (True, False):
+            self.nova.servers.list.reset_mock()
+            servers = controller.iter_servers(self.nova, prefetch=prefetch)
+            self.assertEqual(next(servers).id, '1')
+            self.assertEqual(self.nova.servers.list.call_count, 1)
+
+    def test_prefetch_once_consuming(self):
+        servers = controller.iter_servers(self.nova, prefetch=True)
+        next(servers)
+        next(servers)
+        # The second page is fetched while the first is still being read
+        for _ in range(100):
+            if self.nova.servers.list.call_count == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.nova.servers.list.call_count, 2)
+        self.assertEqual([s.id for s in servers], ['3'])
+
+
+class TestSanityControllerListServers(TestCase):
+
+    def setUp(self):
+        self.state = mock.Mock()
+        self.state.nova.servers.list.return_value = []
+        self.controller = controller.SanityController(self.state)
+
+    def test_filters_passed_to_nova(self):
+        self.controller.list_servers(status='ACTIVE', host='compute-1',
+                                     tags=['a', 'b'], detailed=False)
+        self.state.nova.servers.list.assert_called_once_with(
+            detailed=False,
+            search_opts={'name': '^Sanity-', 'status': 'ACTIVE',
+                         'host': 'compute-1', 'tags': 'a,b'})
+
+    def test_name_escaped(self):
+        self.controller.list_servers(name_startswith='Span.Client-')
+        self.state.nova.servers.list.assert_called_once_with(
+            detailed=True, search_opts={'name': '^Span\\.Client-'})
+
+    def test_incremental(self):
+        self.controller.list_servers(incremental=True)
+        self.state.nova.servers.list.assert_called_once_with(
+            detailed=True, search_opts={'name': '^Sanity-'})
+
+
+class TestWaitForServers(TestCase):
+
+    def setUp(self):
+        self.controller = controller.SanityController(mock.Mock())
+        self.controller.watch_server = self.watch_server
+
+    def watch_server(self, server, states, timeout):
+        future = watcher.ServerFuture(server, states, 60)
+        if server.id == 'stuck':
+            future.set_exception(watcher.ServerTimeout('stuck'))
+        else:
+            future.set_result(server)
+        return future
+
+    def test_all_finished(self):
+        servers = [mock.Mock(id='1'), mock.Mock(id='2')]
+        self.assertEqual(self.controller.wait_for_servers(servers), servers)
+
+    def test_partial_timeout_raised(self):
+        done, stuck = mock.Mock(id='done'), mock.Mock(id='stuck')
+        with self.assertRaises(watcher.ServerTimeout) as raised:
+            self.controller.wait_for_servers([done, stuck])
+        self.assertEqual(raised.exception.servers, [stuck])
+        self.assertEqual(raised.exception.finished, [done])
+
+
+class TestHostInventory(TestCase):
+
+    def make_service(self, id, host, binary='nova-compute'):
+        service = mock.Mock(id=id, host=host, binary=binary,
+                            state='up', status='enabled')
+        del service.hostname
+        return service
+
+    def setUp(self):
+        self.nova = mock.Mock()
+        self.nova.services.list.return_value = [
+            self.make_service(2, 'compute-2.example.com'),
+            self.make_service(1, 'compute-1.example.com'),
+            self.make_service(3, 'scheduler-1', binary='nova-scheduler')]
+        self.inventory = controller.HostInventory(self.nova, ttl=60)
+
+    def test_services_cached(self):
+        services = self.inventory.services()
+        self.assertEqual([s.host for s in services],
+                         ['compute-1.example.com', 'compute-2.example.com'])
+        self.inventory.services()
+        self.inventory.get('compute-1')
+        self.assertEqual(self.nova.services.list.call_count, 1)
+
+        self.inventory.invalidate()
+        self.inventory.services()
+        self.assertEqual(self.nova.services.list.call_count, 2)
+
+    def test_lookup(self):
+        for name in ['compute-1.example.com', 'compute-1', '1', 1]:
+            self.assertEqual(self.inventory.get(name).host,
+                             'compute-1.example.com')
+        self.assertEqual(self.inventory.get('scheduler-1'), None)
+        self.assertEqual(self.inventory.state('compute-2'), 'up')
+        self.assertEqual(self.inventory.status('compute-2'), 'enabled')
+
+
+class TestAggregateMap(TestCase):
+
+    def setUp(self):
+        self.nova = mock.Mock()
+        aggregates = [mock.Mock(hosts=['compute-2', 'compute-1']),
+                      mock.Mock(hosts=['compute-1'])]
+        aggregates[0].name = 'az1'
+        aggregates[1].name = 'ssd'
+        self.nova.aggregates.list.return_value = aggregates
+        self.aggregate_map = controller.AggregateMap(self.nova)
+
+    def test_cached(self):
+        self.assertEqual(self.aggregate_map.aggregates(),
+                         {'az1': ['compute-1', 'compute-2'],
+                          'ssd': ['compute-1']})
+        self.assertEqual(sorted(self.aggregate_map.for_host('compute-1')),
+                         ['az1', 'ssd'])
+        self.assertEqual(self.aggregate_map.for_host('compute-3'), [])
+        self.assertEqual(self.nova.aggregates.list.call_count, 1)
+
+        self.aggregate_map.invalidate()
+        self.aggregate_map.by_host()
+        self.assertEqual(self.nova.aggregates.list.call_count, 2)
+
+
+class TestSanityControllerResults(TestCase):
+
+    def setUp(self):
+        self.state = mock.Mock()
+        self.controller = controller.SanityController(self.state)
+
+    def test_has_failed_tests(self):
+        server = mock.Mock(id='server-1')
+        self.controller.add_test_result('boot', 'host-1', 'server-1',
+                                        results.Success())
+        self.assertFalse(self.controller.has_failed_tests(server))
+
+        self.controller.add_test_result('ping', 'host-1', 'server-1',
+                                        results.Failure('no reply'))
+        self.assertTrue(self.controller.has_failed_tests(server))
+
+        # A later result replaces the earlier one
+        self.controller.add_test_result('ping', 'host-1', 'server-1',
+                                        results.Success())
+        self.assertFalse(self.controller.has_failed_tests(server))
+        self.assertEqual(self.controller.tested_servers('host-1'),
+                         set(['server-1']))
+
+    def test_sink_closed_while_writing(self):
+        sink = self.controller.sink = mock.Mock(filename='results.jsonl')
+
+        def closed(*args):
+            self.controller.sink = None
+            raise ValueError('I/O operation on closed file')
+
+        sink.write.side_effect = closed
+        self.controller.add_test_result('boot', 'host-1', 'server-1',
+                                        results.Success())
+        self.assertEqual(sink.write.call_count, 1)
+        self.controller.add_test_result('ping', 'host-1', 'server-1',
+                                        results.Success())
+        self.assertEqual(sink.write.call_count, 1)
+
+    def test_for_servers_failed_and_passed(self):
+        servers = [mock.Mock(id='server-1', status='ACTIVE'),
+                   mock.Mock(id='server-2', status='ACTIVE')]
+        for server in servers:
+            server.name = 'Sanity-%s' % server.id
+            server.created = server.updated = '2016-01-01T00:00:00Z'
+        self.state.nova.servers.list.side_effect = \
+            lambda detailed, search_opts: \
+            [] if 'marker' in search_opts else servers
+        self.controller.add_test_result('boot', 'host-1', 'server-1',
+                                        results.Error())
+        self.controller.add_test_result('boot', 'host-2', 'server-2',
+                                        results.Success())
+        self.assertEqual(
+            self.controller.for_servers_failed('boot', lambda s: s.id),
+            ['server-1'])
+        self.assertEqual(
+            self.controller.for_servers_passed('boot', lambda s: s.id),
+            ['server-2'])
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+import mock
+import openstack.profile
+import requests
+from six.moves import BaseHTTPServer
+
+from sanity import os_sdk
+
+
+@mock.patch('sanity.os_sdk.create_connection')
+class TestConnectionManager(TestCase):
+
+    ARGS = ('http://keystone:5000/v2.0', 'project', 'user', 'secret')
+
+    def setUp(self):
+        self.connections = os_sdk.ConnectionManager()
+
+    def test_shared_until_released(self, create_connection):
+        first = self.connections.acquire(*self.ARGS, endpoint_type='public')
+        second = self.connections.acquire(*self.ARGS, endpoint_type='public')
+        self.assertIs(first, second)
+        self.assertEqual(create_connection.call_count, 1)
+
+        self.connections.release(first)
+        self.assertEqual(len(self.connections), 1)
+        self.connections.release(second)
+        self.assertEqual(len(self.connections), 0)
+
+        self.connections.acquire(*self.ARGS, endpoint_type='public')
+        self.assertEqual(create_connection.call_count, 2)
+
+    def test_different_credentials(self, create_connection):
+        first = self.connections.acquire(*self.ARGS)
+        other = self.connections.acquire(*self.ARGS[:3] + ('other',))
+        self.assertIsNot(first, other)
+        self.assertEqual(create_connection.call_count, 2)
+
+    def test_pool_size_on_create(self, create_connection):
+        self.connections.acquire(*self.ARGS, pool_size=30)
+        self.connections.acquire(*self.ARGS)
+        self.assertEqual(create_connection.call_count, 1)
+        self.assertEqual(create_connection.call_args[1]['pool_size'], 30)
+
+    def test_concurrent_acquire(self, create_connection):
+        acquired = []
+
+        def acquire():
+            acquired.append(self.connections.acquire(*self.ARGS))
+
+        threads = [threading.Thread(target=acquire) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(create_connection.call_count, 1)
+        self.assertEqual(len(set(id(c) for c in acquired)), 1)
+
+
+def auth_state(token, expires_in):
+    expires = datetime.utcnow() + timedelta(seconds=expires_in)
+    return json.dumps({
+        'auth_token': token,
+        'body': {'access': {
+            'token': {'id': token,
+                      'expires': expires.strftime('%Y-%m-%dT%H:%M:%SZ')},
+            'serviceCatalog': [],
+            'user': {'id': 'user-id', 'name': 'user'},
+        }},
+    })
+
+
+class TestTokenCache(TestCase):
+
+    KEY = os_sdk.TokenCache.key('http://keystone:5000/v2.0', 'user',
+                                'project')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'tokens.json')
+        self.cache = os_sdk.TokenCache(self.filename, refresh=300)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        state = auth_state('token', 3600)
+        self.cache.save(self.KEY, state)
+        self.assertEqual(self.cache.load(self.KEY), state)
+        self.assertIsNone(self.cache.load('other'))
+        mode = stat.S_IMODE(os.stat(self.filename).st_mode)
+        self.assertEqual(mode, 0o600)
+
+    def test_expiring_soon(self):
+        self.cache.save(self.KEY, auth_state('token', 60))
+        self.assertIsNone(self.cache.load(self.KEY))
+
+    def test_readable_by_others(self):
+        self.cache.save(self.KEY, auth_state('token', 3600))
+        os.chmod(self.filename, 0o644)
+        self.assertIsNone(self.cache.load(self.KEY))
+
+    def test_password_uses_cache(self):
+        self.cache.save(self.KEY, auth_state('cached', 3600))
+        auth = os_sdk.Password(auth_url='http://keystone:5000/v2.0',
+                               username='user', password='secret',
+                               project_name='project')
+        auth.use_token_cache(self.cache, self.KEY)
+        with mock.patch.object(auth, 'get_auth_ref') as get_auth_ref:
+            self.assertEqual(auth.get_token(mock.Mock()), 'cached')
+            self.assertFalse(get_auth_ref.called)
+
+    def test_password_saves_new_token(self):
+        auth = os_sdk.Password(auth_url='http://keystone:5000/v2.0',
+                               username='user', password='secret',
+                               project_name='project')
+        auth.use_token_cache(self.cache, self.KEY)
+        state = json.loads(auth_state('fresh', 3600))
+        new_ref = os_sdk.access.create(body=state['body'],
+                                       auth_token='fresh')
+        with mock.patch.object(auth, 'get_auth_ref', return_value=new_ref):
+            self.assertEqual(auth.get_token(mock.Mock()), 'fresh')
+        self.assertEqual(json.loads(self.cache.load(self.KEY))['auth_token'],
+                         'fresh')
+
+
+def token(name, expires_in):
+    state = json.loads(auth_state(name, expires_in))
+    return os_sdk.access.create(body=state['body'], auth_token=name)
+
+
+class TestTokenRefresh(TestCase):
+
+    def setUp(self):
+        self.auth = os_sdk.Password(auth_url='http://keystone:5000/v2.0',
+                                    username='user', password='secret',
+                                    project_name='project')
+        self.auth.auth_ref = token('old', 3600)
+        self.session = mock.Mock()
+        self.tokens = ['new-%s' % i for i in range(10)]
+        patcher = mock.patch.object(
+            os_sdk.BasePassword, 'get_auth_ref',
+            side_effect=lambda *args, **kwargs: token(self.tokens.pop(0),
+                                                      3600))
+        self.get_auth_ref = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_single_flight_reauth(self):
+        seen = []
+
+        def rejected():
+            # Every thread's request was rejected with the old token
+            self.auth.invalidate()
+            seen.append(self.auth.get_token(self.session))
+
+        threads = [threading.Thread(target=rejected) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.get_auth_ref.call_count, 1)
+        self.assertEqual(set(seen), set(['new-0']))
+
+    def test_invalidate_after_grace(self):
+        self.assertTrue(self.auth.invalidate())
+        self.assertEqual(self.auth.get_token(self.session), 'new-0')
+        self.assertTrue(self.auth.invalidate())
+        self.assertEqual(self.auth.get_token(self.session), 'new-0')
+        self.auth._refreshed_at -= self.auth.reauth_grace
+        self.assertTrue(self.auth.invalidate())
+        self.assertEqual(self.auth.get_token(self.session), 'new-1')
+
+    @mock.patch('sanity.os_sdk.threading.Timer')
+    def test_schedules_refresh(self, timer):
+        self.auth.refresh_before = 300
+        self.auth.get_token(self.session)
+        delay, refresh, args = timer.call_args[0]
+        self.assertAlmostEqual(delay, 3300, delta=5)
+        self.assertTrue(timer.return_value.start.called)
+
+        refresh(*args)
+        self.assertEqual(self.auth.get_token(self.session), 'new-0')
+        self.assertEqual(timer.call_count, 2)
+
+    @mock.patch('sanity.os_sdk.threading.Timer')
+    def test_short_token_refreshed_half_way(self, timer):
+        self.auth.refresh_before = 300
+        self.auth.auth_ref = token('short', 400)
+        self.auth.get_token(self.session)
+        self.assertAlmostEqual(timer.call_args[0][0], 200, delta=5)
+
+    def test_refresh_disabled(self):
+        self.auth.get_token(self.session)
+        self.assertIsNone(self.auth._timer)
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPoolAdapter(TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        self.stats = os_sdk.PoolStats()
+        self.session = requests.Session()
+        self.session.mount('http://', os_sdk.PoolAdapter(self.stats))
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuses_connection(self):
+        for _ in range(3):
+            self.session.get(self.url)
+        self.assertEqual(self.stats.misses, 1)
+        self.assertEqual(self.stats.hits, 2)
+        self.assertEqual(self.stats.connections, 1)
+        self.assertEqual(self.stats.discarded, 0)
+
+    def test_discards_when_full(self):
+        self.session.mount('http://', os_sdk.PoolAdapter(
+            self.stats, pool_maxsize=1))
+        pool = self.session.get_adapter(self.url).get_connection(self.url)
+        first, second = pool._get_conn(), pool._get_conn()
+        pool._put_conn(first)
+        pool._put_conn(second)
+        self.assertEqual(self.stats.misses, 2)
+        self.assertEqual(self.stats.discarded, 1)
+
+
+class TestPoolSize(TestCase):
+
+    def test_default_pool_size(self):
+        self.assertEqual(os_sdk.default_pool_size(),
+                         os_sdk.DEFAULT_POOL_SIZE)
+        self.assertEqual(os_sdk.default_pool_size(50),
+                         50 + os_sdk.EXTRA_WORKERS)
+
+    def test_configured_pool_size(self):
+        os_sdk.CONF.set_override('http_pool_size', 5)
+        self.addCleanup(os_sdk.CONF.clear_override, 'http_pool_size')
+        self.assertEqual(os_sdk.default_pool_size(50), 5)
+
+    def test_session_mounts_pool(self):
+        session = os_sdk.Session(openstack.profile.Profile(), pool_size=25)
+        adapter = session.session.get_adapter('https://nova:8774/')
+        self.assertIsInstance(adapter, os_sdk.PoolAdapter)
+        self.assertEqual(adapter._pool_maxsize, 25)
+        self.assertIs(adapter.stats, session.pool_stats)
+
+
+@mock.patch('openstack.session.Session.request')
+class TestSessionCoalescing(TestCase):
+
+    def setUp(self):
+        self.session = os_sdk.Session(openstack.profile.Profile(),
+                                      coalescer=mock.Mock())
+        self.session.coalescer.call.side_effect = (
+            lambda key, fn, *args, **kwargs: fn(*args, **kwargs))
+
+    def test_gets_coalesced(self, request):
+        self.session.request('/servers', 'GET', endpoint_filter={'a': 1})
+        key = self.session.coalescer.call.call_args[0][0]
+        self.session.request('/servers', 'GET', endpoint_filter={'a': 1})
+        self.assertEqual(self.session.coalescer.call.call_args[0][0], key)
+        self.session.request('/servers', 'GET', endpoint_filter={'a': 2})
+        self.assertNotEqual(self.session.coalescer.call.call_args[0][0], key)
+        self.assertEqual(request.call_args[1]['connect_retries'], 5)
+
+    def test_other_methods_not_coalesced(self, request):
+        self.session.request('/servers', 'POST', json={})
+        self.session.request('/servers', 'GET', stream=True)
+        self.assertFalse(self.session.coalescer.call.called)
+        self.assertEqual(request.call_count, 2)
+
+    def test_no_coalescer(self, request):
+        self.session.coalescer = None
+        self.session.request('/servers', 'GET')
+        self.assertEqual(request.call_count, 1)
+
+
+def response(status_code=200, **headers):
+    return mock.Mock(status_code=status_code, headers=headers)
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        self.cache = os_sdk.ResponseCache({'flavors': 60, 'networks': 60,
+                                           'services': 0})
+
+    def test_resource(self):
+        self.assertEqual(self.cache.resource('/flavors/detail?limit=5'),
+                         'flavors')
+        self.assertEqual(self.cache.resource(
+            'https://neutron:9696/v2.0/networks.json'), 'networks')
+        self.assertEqual(self.cache.resource('networks'), 'networks')
+        self.assertIsNone(self.cache.resource('/os-services'))
+        self.assertIsNone(self.cache.resource('/servers/detail'))
+        self.assertIsNone(self.cache.resource('/flavorsomething'))
+
+    def test_cached_until_invalidated(self):
+        fetch = mock.Mock(return_value=response())
+        first = self.cache.get('key', 'flavors', fetch)
+        self.assertIs(self.cache.get('key', 'flavors', fetch), first)
+        self.assertEqual(fetch.call_count, 1)
+
+        self.cache.invalidate('networks')
+        self.cache.get('key', 'flavors', fetch)
+        self.assertEqual(fetch.call_count, 1)
+        self.cache.invalidate('flavors')
+        self.cache.get('key', 'flavors', fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_errors_not_cached(self):
+        fetch = mock.Mock(return_value=response(404))
+        self.cache.get('key', 'flavors', fetch)
+        self.cache.get('key', 'flavors', fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_revalidates_expired(self):
+        cached = response(ETag='"abc"')
+        fetch = mock.Mock(side_effect=[cached, response(304)])
+        self.cache.get('key', 'flavors', fetch)
+        self.assertEqual(fetch.call_args[0][0], {})
+
+        with mock.patch('sanity.os_sdk.time.time',
+                        return_value=os_sdk.time.time() + 120):
+            self.assertIs(self.cache.get('key', 'flavors', fetch), cached)
+        self.assertEqual(fetch.call_args[0][0], {'If-None-Match': '"abc"'})
+        self.assertEqual(self.cache.revalidated, 1)
+
+    def test_change_during_fetch_not_cached(self):
+        def fetch(headers):
+            self.cache.invalidate('flavors')
+            return response()
+
+        self.cache.get('key', 'flavors', fetch)
+        fetch = mock.Mock(return_value=response())
+        self.cache.get('key', 'flavors', fetch)
+        self.assertEqual(fetch.call_count, 1)
+
+
+@mock.patch('openstack.session.Session.request')
+class TestSessionResponseCache(TestCase):
+
+    def setUp(self):
+        self.session = os_sdk.Session(
+            openstack.profile.Profile(),
+            response_cache=os_sdk.ResponseCache({'networks': 60}))
+
+    def test_writes_invalidate(self, request):
+        request.return_value = response()
+        self.session.request('networks', 'GET', params={'name': 'net'})
+        self.session.request('networks', 'GET', params={'name': 'net'})
+        self.assertEqual(request.call_count, 1)
+
+        self.session.request('networks', 'POST', json={})
+        self.session.request('networks', 'GET', params={'name': 'net'})
+        self.assertEqual(request.call_count, 3)
+
+    def test_uncached_resources(self, request):
+        request.return_value = response()
+        self.session.request('/servers/detail', 'GET')
+        self.session.request('/servers/detail', 'GET')
+        self.assertEqual(request.call_count, 2)
+
+    def test_invalidate_cached(self, request):
+        request.return_value = response()
+        self.session.request('networks', 'GET')
+        nova = mock.Mock()
+        nova.client.session = self.session
+        os_sdk.invalidate_cached(nova, 'networks')
+        self.session.request('networks', 'GET')
+        self.assertEqual(request.call_count, 2)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import TestCase
+
+import mock
+
+from sanity import reconcile
+
+
+def make_server(uuid, name):
+    server = mock.Mock(id=uuid)
+    server.name = name
+    return server
+
+
+class TestReconciler(TestCase):
+
+    def setUp(self):
+        self.state = mock.Mock(_network_name='qa-span-network',
+                               _security_group_name='qaspansecg-{0}')
+        self.neutron = self.state.neutron
+        self.controller = mock.Mock(name_prefix='Sanity-')
+        self.servers = {
+            'Sanity-': [make_server('s-1', 'Sanity-host-1')],
+            'Span-Client-': [make_server('s-2', 'Span-Client-host-2')],
+        }
+        self.controller.iter_servers.side_effect = \
+            lambda name_startswith, detailed: self.servers[name_startswith]
+        self.neutron.ips.return_value = [
+            {'id': 'ip-1', 'floating_ip_address': '1.1.1.1',
+             'port_id': None},
+            {'id': 'ip-2', 'floating_ip_address': '1.1.1.2',
+             'port_id': 'port-9'}]
+        self.neutron.networks.return_value = [{'id': 'net-1'}]
+        self.neutron.ports.return_value = [
+            {'id': 'port-1', 'name': '', 'network_id': 'net-1',
+             'device_id': ''},
+            {'id': 'port-2', 'name': '', 'network_id': 'net-1',
+             'device_id': 's-1'},
+            {'id': 'port-3', 'name': '', 'network_id': 'net-2',
+             'device_id': ''}]
+        self.neutron.security_groups.return_value = [
+            {'id': 'sg-1', 'name': 'qaspansecg-1234'},
+            {'id': 'sg-2', 'name': 'default'}]
+        self.reconciler = reconcile.Reconciler(self.state, self.controller)
+
+    def test_find(self):
+        orphans = self.reconciler.find()
+        self.assertEqual(
+            dict((kind, sorted(orphan.id for orphan in found))
+                 for kind, found in orphans.items()),
+            {reconcile.SERVERS: ['s-1', 's-2'],
+             reconcile.FLOATING_IPS: ['ip-1'],
+             reconcile.PORTS: ['port-1'],
+             reconcile.SECURITY_GROUPS: ['sg-1']})
+        # One listing for each kind of resource
+        self.assertEqual(self.neutron.ports.call_count, 1)
+        self.assertEqual(self.neutron.ips.call_count, 1)
+        self.assertEqual(len(self.reconciler.report(orphans)._rows), 5)
+
+    @mock.patch('sanity.reconcile.time.sleep')
+    def test_delete(self, sleep):
+        order = []
+        sleep.side_effect = lambda seconds: order.append('wait')
+        self.neutron.delete_security_group.side_effect = \
+            lambda *args: order.append('security group')
+        self.neutron.delete_ip.side_effect = Exception('Conflict')
+
+        orphans = self.reconciler.find()
+        # The old server isn't in the watcher's index, it's listed until
+        # it's gone
+        old_server = self.servers['Span-Client-']
+        polls = [old_server, old_server, old_server, []]
+        self.controller.iter_servers.side_effect = \
+            lambda name_startswith, detailed: (
+                polls.pop(0) if name_startswith == 'Span-Client-' else [])
+        failed = self.reconciler.delete(orphans)
+
+        self.assertEqual([orphan.id for orphan in failed], ['ip-1'])
+        for server in orphans[reconcile.SERVERS]:
+            server.resource.delete.assert_called_once_with()
+        self.neutron.delete_port.assert_called_once_with('port-1')
+        self.assertEqual(order, ['wait', 'wait', 'wait', 'security group'])
+        self.assertFalse(self.controller.wait_for_servers.called)
+
+    @mock.patch('sanity.reconcile.time')
+    def test_delete_timed_out(self, mock_time):
+        now = [0]
+
+        def sleep(seconds):
+            now[0] += seconds
+        mock_time.time.side_effect = lambda: now[0]
+        mock_time.sleep.side_effect = sleep
+        orphans = self.reconciler.find()
+        self.neutron.delete_security_group.side_effect = \
+            Exception('In use')
+
+        failed = self.reconciler.delete(orphans)
+
+        self.assertEqual(sorted(orphan.id for orphan in failed),
+                         ['s-1', 's-2', 'sg-1'])
+        self.assertEqual(now, [self.reconciler.timeout])
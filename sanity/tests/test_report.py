@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+
+import pytest
+
+from datetime import timedelta
+
+from sanity import cli
+from sanity import report
+from sanity import results
+from sanity import scenarios
+from sanity import sink
+from sanity.scenarios.console import CloudInitSuccess
+
+
+SNAPSHOT = {
+    'hosts': ['host-1', 'host-2', 'host-3'],
+    'aggregates': {'az1': ['host-1', 'host-2'], 'ssd': ['host-2']},
+}
+
+
+def write_results(stream):
+    stream.write('boot', 'host-1', 'server-1', results.Success())
+    stream.write('ping', 'host-1', 'server-1',
+                 results.Failure('no reply', exception='timeout'))
+    stream.write('boot', 'host-2', 'server-2', results.Error('boom'))
+
+
+@pytest.fixture
+def stream_file(tmpdir):
+    path = str(tmpdir.join('results.jsonl'))
+    stream = sink.ResultSink(path)
+    stream.write_snapshot(SNAPSHOT)
+    write_results(stream)
+    stream.close()
+    return path
+
+
+def test_from_dict():
+    failure = results.Failure('no reply', exception='timeout')
+    assert results.from_dict(failure.to_dict()).to_dict() == \
+        failure.to_dict()
+    assert type(results.from_dict({'result': 'Skipped'})) is \
+        results.Skipped
+    assert type(results.from_dict({'result': 'Unknown'})) is results.Result
+
+
+def test_from_dict_cloud_init():
+    success = CloudInitSuccess(boot_time='42.5')
+    success.duration = timedelta(seconds=75)
+    data = success.to_dict()
+    assert data['duration'] == 42
+    assert data['wall_time'] == 75
+    loaded = results.from_dict(data)
+    assert loaded.duration == timedelta(seconds=75)
+    assert loaded.boot_time == '42.5'
+    assert str(loaded) == 'PASS 01:15'
+
+
+def test_stored_results_from_stream(stream_file):
+    stored = report.StoredResults.load(stream_file)
+    table, missing_hosts = stored.report_results()
+    assert missing_hosts == set(['host-3'])
+    assert len(table._rows) == 2
+
+    failures = stored.report_failures()
+    assert [(h, s, r.reason) for h, s, r in failures['ping']] == \
+        [('host-1', 'server-1', 'no reply')]
+    assert [h for h, s, r in stored.report_errors()['boot']] == ['host-2']
+
+    aggregates = stored.report_aggregates()
+    assert sorted(row[1] for row in aggregates._rows) == ['az1', 'az1,ssd']
+    assert len(stored.report_aggregates(all_hosts=True)._rows) == 3
+
+
+def test_stored_results_from_json_report(tmpdir, stream_file):
+    path = str(tmpdir.join('report.json'))
+    with open(path, 'w') as f:
+        json.dump(sink.fold_results(sink.read_results(stream_file)), f)
+
+    stored = report.StoredResults.load(path)
+    assert stored.hosts == []
+    assert stored.report_results()[1] == set()
+
+    stored = report.StoredResults.load(path, snapshot_filename=stream_file)
+    assert stored.report_results()[1] == set(['host-3'])
+
+
+def test_filter(stream_file):
+    stored = report.StoredResults.load(stream_file)
+    filtered = stored.filter(hosts=['host-1', 'host-3'], tests=['boot'])
+    assert list(filtered.test_results) == ['boot']
+    assert list(filtered.test_results['boot']) == [('host-1', 'server-1')]
+    assert filtered.report_results()[1] == set(['host-3'])
+
+
+def test_percentile():
+    values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert report.percentile(values, 50) == 5
+    assert report.percentile(values, 95) == 10
+    assert report.percentile([3], 95) == 3
+    assert report.percentile([], 50) is None
+
+
+def test_rollup():
+    def result(cls, seconds, *args):
+        result = cls(*args)
+        result.duration = timedelta(seconds=seconds)
+        return result
+
+    test_results = {
+        'boot': {('host-1', 's1'): result(results.Success, 10),
+                 ('host-2', 's2'): result(results.Failure, 30, 'slow'),
+                 ('host-3', 's3'): result(results.Error, 50)},
+        'ping': {('host-1', 's1'): result(results.Skipped, 0)},
+    }
+    aggregates = report.host_aggregates(SNAPSHOT['aggregates'])
+    rolled_up = report.rollup(test_results, aggregates)
+
+    assert rolled_up[(report.ALL_HOSTS, 'boot')] == {
+        'hosts': 3, 'pass': 1, 'fail': 1, 'error': 1, 'skipped': 0,
+        'p50': 30, 'p95': 50}
+    assert rolled_up[('az1', 'boot')]['hosts'] == 2
+    assert rolled_up[('ssd', 'boot')]['fail'] == 1
+    assert rolled_up[(report.NO_AGGREGATE, 'boot')]['error'] == 1
+    assert rolled_up[('az1', 'ping')]['p50'] is None
+
+    table = report.rollup_table(test_results, aggregates)
+    assert [row[0] for row in table._rows][:2] == [report.ALL_HOSTS] * 2
+    assert table._rows[-1][0] == report.NO_AGGREGATE
+
+
+def test_passes_rendered(tmpdir):
+    path = str(tmpdir.join('results.jsonl'))
+    stream = sink.ResultSink(path)
+    success = scenarios.Success()
+    success.duration = timedelta(seconds=65)
+    stream.write('boot', 'host-1', 'server-1', success)
+    stream.close()
+
+    table, missing_hosts = report.StoredResults.load(path).report_results()
+    assert table._rows == [['host-1', 'server-1', 'PASS 01:05']]
+    assert 'PASS 01:05' in table.get_string()
+    assert 'object at' not in table.get_string()
+
+
+def test_print_report(stream_file, capsys):
+    cli.print_report(cli.SimpleSanity(report.StoredResults.load(stream_file)))
+    out, err = capsys.readouterr()
+    assert 'no reply' in out
+    assert 'host-3' in out
+    assert 'Aggregate Rollup' in out
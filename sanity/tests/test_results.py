@@ -14,9 +14,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from datetime import timedelta
+import pickle
+import threading
+
 import pytest
 
 from sanity import results
+from sanity import scenarios
+from sanity.scenarios.console import CloudInitSuccess
 
 
 @pytest.mark.parametrize(
@@ -26,3 +32,128 @@ from sanity import results
 def test_result_type_has_duration(class_name):
     result = getattr(results, class_name)()
     assert 'duration' in result.to_dict()
+
+
+@pytest.mark.parametrize(
+    'class_name',
+    ['Result', 'Success', 'Failure', 'Error', 'Skipped']
+)
+def test_result_type_has_no_dict(class_name):
+    result = getattr(results, class_name)()
+    assert not hasattr(result, '__dict__')
+
+
+def test_result_duration():
+    result = results.Success()
+    assert result.duration == timedelta(0)
+    result.duration = timedelta(seconds=90, microseconds=500)
+    assert result.duration.seconds == 90
+    assert result._duration == 90.0005
+
+
+def test_result_extra():
+    result = results.Failure('no reply', output='x' * 10000)
+    assert len(result.output) == 10000
+    with pytest.raises(AttributeError):
+        result.missing
+    success = scenarios.Success(result={'received': '5'})
+    assert success.result == {'received': '5'}
+    assert not hasattr(success, '__dict__')
+
+
+def test_result_pickle():
+    result = CloudInitSuccess(boot_time='12.5')
+    result.duration = timedelta(seconds=3)
+    copy = pickle.loads(pickle.dumps(result, 2))
+    assert copy.boot_time == '12.5'
+    assert copy.duration.seconds == 3
+
+
+def test_result_table():
+    table = results.ResultTable()
+    try:
+        raise ValueError('boom')
+    except ValueError as e:
+        failure = results.Failure('no reply', exception=e)
+    failure.duration = timedelta(seconds=5)
+    table.set('console', 'host-1', 'server-1', CloudInitSuccess('12.5'))
+    table.set('ping', 'host-1', 'server-1', failure)
+    table.set('ping', 'host-2', 'server-2', results.Skipped())
+    assert len(table) == 3
+    assert table.get('ping', 'host-3', 'server-3') is None
+
+    result = table.get('ping', 'host-1', 'server-1')
+    assert type(result) is results.Failure
+    assert result.to_dict() == failure.to_dict()
+    assert str(table.get('console', 'host-1', 'server-1')).startswith(
+        'PASS (12.5)')
+
+    table.set('ping', 'host-1', 'server-1', results.Success())
+    assert len(table) == 3
+    assert table.counts() == {('console', results.SUCCESS): 1,
+                              ('ping', results.SUCCESS): 1,
+                              ('ping', results.SKIPPED): 1}
+    assert sorted(table.snapshot()['ping']) == [('host-1', 'server-1'),
+                                                ('host-2', 'server-2')]
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_result_store_indexes(compact):
+    store = results.ResultStore(compact=compact)
+    store.add('boot', 'host-1', 'server-1', results.Success())
+    store.add('boot', 'host-1', 'server-2', results.Error())
+    store.add('ping', 'host-1', 'server-2', results.Skipped())
+    assert store.failed_servers('boot') == set(['server-2'])
+    assert store.passed_servers('boot') == set(['server-1'])
+    assert store.passed_servers('ping') == set()
+    assert store.has_failures('server-2')
+    assert store.servers_on_host('host-1') == set(['server-1', 'server-2'])
+
+    # A later result replaces the earlier one
+    store.add('boot', 'host-1', 'server-2', results.Success())
+    assert not store.has_failures('server-2')
+    assert store.passed_servers('boot') == set(['server-1', 'server-2'])
+    assert len(store) == 3
+
+
+def test_result_store_snapshot_is_a_copy():
+    store = results.ResultStore()
+    store.add('boot', 'host-1', 'server-1', results.Success())
+    snapshot = store.snapshot()
+    store.add('boot', 'host-1', 'server-2', results.Success())
+    store.add('ping', 'host-1', 'server-1', results.Success())
+    assert list(snapshot) == ['boot']
+    assert list(snapshot['boot']) == [('host-1', 'server-1')]
+
+
+def test_result_store_concurrent_writes():
+    store = results.ResultStore()
+
+    def add(thread):
+        for i in range(200):
+            store.add('boot', 'host-%s' % thread, 'server-%s' % i,
+                      results.Success())
+            store.snapshot()
+
+    threads = [threading.Thread(target=add, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(store) == 1600
+    assert len(store.snapshot()['boot']) == 1600
+
+
+def test_result_table_truncates_when_asked():
+    result = results.Failure('no reply', output='x' * 10000 + 'end')
+    table = results.ResultTable()
+    table.set('ping', 'host-1', 'server-1', result)
+    assert len(table.get('ping', 'host-1', 'server-1').output) == 10003
+
+    table = results.ResultTable(max_extra_length=4096)
+    table.set('ping', 'host-1', 'server-1', result)
+    output = table.get('ping', 'host-1', 'server-1').output
+    assert len(output) == 4096
+    assert output.endswith('end')
+    # The result itself keeps everything
+    assert len(result.output) == 10003
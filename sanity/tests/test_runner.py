@@ -15,11 +15,16 @@
 #    under the License.
 
 from unittest import TestCase
+import threading
+import time
+
 import mock
 
 from sanity import runner
 from sanity import results
 from sanity import fixtures
+from sanity import os_sdk
+from sanity import scenarios
 
 
 class MockFixture(mock.Mock):
@@ -75,3 +80,126 @@ class TestSanityState(TestCase):
         result = r.setUpFixtures()
         self.assertTrue(isinstance(result, results.Failure))
         self.assertTrue(result.is_failure())
+
+
+class TestRunnerConnections(TestCase):
+
+    DEFAULT_ARGS = TestSanityState.DEFAULT_ARGS
+
+    @mock.patch('sanity.os_sdk.create_connection')
+    def test_runners_share_connection(self, create_connection):
+        connections = os_sdk.ConnectionManager()
+        runners = [runner.Runner(*self.DEFAULT_ARGS, state={},
+                                 connections=connections)
+                   for _ in range(3)]
+        self.assertEqual(create_connection.call_count, 1)
+        self.assertTrue(all(r.nova is runners[0].nova for r in runners))
+
+        for r in runners:
+            r.close()
+            r.close()
+        self.assertEqual(len(connections), 0)
+
+
+class SleepScenario(scenarios.SanityScenario):
+    concurrent = True
+
+    def _test_server(self, server):
+        self._state.setdefault('threads', set()).add(
+            threading.current_thread().ident)
+        time.sleep(0.2)
+        return results.Success()
+
+
+class SleepScenario1(SleepScenario):
+    name = 'sleep-1'
+
+
+class SleepScenario2(SleepScenario):
+    name = 'sleep-2'
+
+
+class SerialScenario(SleepScenario):
+    name = 'serial'
+    concurrent = False
+
+
+class FixtureScenario(SleepScenario):
+    name = 'fixture'
+
+    @fixtures.useFixture(MockFixture)
+    def _test_server(self, server, fixture):
+        return results.Success()
+
+
+@mock.patch('sanity.os_sdk.create_connection')
+class TestRunServer(TestCase):
+
+    DEFAULT_ARGS = TestSanityState.DEFAULT_ARGS
+
+    def setUp(self):
+        self.sanity = mock.Mock()
+        self.server = mock.Mock(id='server-1', **{
+            'OS-EXT-SRV-ATTR:host': 'compute-1'})
+
+    def make_runner(self, tests, **kwargs):
+        return runner.Runner(*self.DEFAULT_ARGS, state={}, tests=tests,
+                             connections=os_sdk.ConnectionManager(),
+                             **kwargs)
+
+    def recorded(self):
+        return sorted(call[0][0]
+                      for call in self.sanity.add_test_result.call_args_list)
+
+    def test_concurrent_scenarios(self, create_connection):
+        r = self.make_runner([SleepScenario1, SleepScenario2,
+                              SerialScenario])
+        started = time.time()
+        r.run_server(self.sanity, self.server)
+        # The concurrent pair take 0.2s together, then the serial one
+        self.assertLess(time.time() - started, 0.55)
+        self.assertEqual(self.recorded(), ['serial', 'sleep-1', 'sleep-2'])
+        self.assertEqual(len(r.get_state()['threads']), 3)
+        self.assertEqual(
+            self.sanity.add_test_result.call_args_list[-1][0][0], 'serial')
+
+    @mock.patch('sanity.scenarios.console.time.sleep')
+    def test_float_waits_for_console(self, sleep, create_connection):
+        events = []
+
+        def console_output():
+            events.append('console')
+            return 'Cloud-init v. 0.7 finished at now. Up 10.5 seconds'
+
+        def float_test(test, server, floating_ip):
+            events.append('float')
+            return results.Success()
+
+        self.server.status = 'ACTIVE'
+        self.server.get_console_output.side_effect = console_output
+        r = self.make_runner([scenarios.FloatScenario,
+                              scenarios.ConsoleScenario])
+        fixture = r.fixtures[fixtures.FloatingIPFixture] = mock.Mock()
+        for method in ('setUp', 'enableFixture', 'disableFixture'):
+            getattr(fixture, method).return_value = results.Success()
+        with mock.patch.object(scenarios.FloatScenario, '_test_server',
+                               fixtures.useFixture(
+                                   fixtures.FloatingIPFixture)(float_test)):
+            r.run_server(self.sanity, self.server)
+        self.assertEqual(events, ['console', 'float'])
+        self.assertEqual(self.recorded(), [scenarios.ConsoleScenario.name,
+                                           scenarios.FloatScenario.name])
+
+    def test_not_concurrent(self, create_connection):
+        r = self.make_runner([SleepScenario1, SleepScenario2],
+                             concurrent=False)
+        started = time.time()
+        r.run_server(self.sanity, self.server)
+        self.assertGreaterEqual(time.time() - started, 0.4)
+        self.assertEqual(r.get_state()['threads'],
+                         set([threading.current_thread().ident]))
+
+    def test_fixtures_run_serially(self, create_connection):
+        r = self.make_runner([SleepScenario1, FixtureScenario])
+        self.assertTrue(r.is_concurrent(r.tests[0]))
+        self.assertFalse(r.is_concurrent(r.tests[1]))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+import mock
+import pytest
+
+from sanity import controller
+from sanity import results
+from sanity import sink
+
+
+@pytest.mark.parametrize('filename', ['results.jsonl', 'results.jsonl.gz'])
+def test_stream_round_trip(tmpdir, filename):
+    path = str(tmpdir.join(filename))
+    stream = sink.ResultSink(path, fsync_interval=0)
+    stream.write('boot', 'host-1', 'server-1', results.Success())
+    stream.write('ping', 'host-1', 'server-1', results.Failure('no reply'))
+    stream.write('ping', 'host-1', 'server-1', results.Success())
+    stream.close()
+
+    records = list(sink.read_results(path))
+    assert [record['test'] for record in records] == ['boot', 'ping', 'ping']
+    assert records[1]['result']['reason'] == 'no reply'
+
+    folded = sink.fold_results(records)
+    assert folded == {
+        'boot': [('host-1', 'server-1', results.Success().to_dict())],
+        'ping': [('host-1', 'server-1', results.Success().to_dict())],
+    }
+
+
+def test_stream_is_readable_while_running(tmpdir):
+    path = str(tmpdir.join('results.jsonl'))
+    stream = sink.ResultSink(path, fsync_interval=None)
+    stream.write('boot', 'host-1', 'server-1', results.Success())
+    assert len(list(sink.read_results(path))) == 1
+    stream.close()
+
+
+def test_truncated_stream(tmpdir):
+    path = str(tmpdir.join('results.jsonl.gz'))
+    stream = sink.ResultSink(path)
+    for i in range(100):
+        stream.write('boot', 'host-%s' % i, 'server-%s' % i,
+                     results.Success())
+    stream.sync()
+    # Simulate the process dying before the gzip stream is finished
+    size = os.path.getsize(path)
+    stream._file.close()
+    with open(path, 'rb+') as f:
+        f.truncate(size)
+    assert len(list(sink.read_results(path))) == 100
+
+    path = str(tmpdir.join('results.jsonl'))
+    with open(path, 'w') as f:
+        f.write('{"test": "boot", "host": "h", "server": "s", '
+                '"result": {}}\n{"test": "bo')
+    assert len(list(sink.read_results(path))) == 1
+
+
+def test_controller_writes_results(tmpdir):
+    insanity = controller.SanityController(mock.Mock())
+    insanity.sink = sink.ResultSink(str(tmpdir.join('results.jsonl')))
+    insanity.add_test_result('boot', 'host-1', 'server-1', results.Success())
+    insanity.sink.close()
+    assert insanity.sink.count == 1
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import TestCase
+import threading
+import time
+
+import mock
+
+from sanity import util
+
+
+class TestRunGraph(TestCase):
+
+    def test_dependency_order(self):
+        order = []
+
+        def task(name):
+            def fn():
+                time.sleep(0.01)
+                order.append(name)
+                return name
+            return fn
+
+        results = util.run_graph({
+            'router': (task('router'), ['external_net']),
+            'network': (task('network'), ['router']),
+            'external_net': (task('external_net'), []),
+        })
+        self.assertEqual(order, ['external_net', 'router', 'network'])
+        self.assertEqual(results['network'], 'network')
+
+    def test_independent_tasks_run_concurrently(self):
+        barrier = threading.Event()
+        arrived = []
+
+        def task():
+            arrived.append(1)
+            if len(arrived) == 3:
+                barrier.set()
+            # Only returns if all three are running at once
+            self.assertTrue(barrier.wait(5))
+
+        util.run_graph(dict((name, (task, [])) for name in 'abc'))
+
+    def test_error_stops_dependents(self):
+        called = []
+
+        def fail():
+            raise KeyError('flavor')
+
+        with self.assertRaises(KeyError):
+            util.run_graph({
+                'flavor': (fail, []),
+                'boot': (lambda: called.append('boot'), ['flavor']),
+            })
+        self.assertEqual(called, [])
+
+    def test_bad_graphs(self):
+        with self.assertRaises(ValueError):
+            util.run_graph({'a': (lambda: None, ['missing'])})
+        with self.assertRaises(ValueError):
+            util.run_graph({'a': (lambda: None, ['b']),
+                            'b': (lambda: None, ['a'])})
+
+    def test_max_workers(self):
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def task():
+            with lock:
+                running.append(1)
+                most.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        util.run_graph(dict((name, (task, [])) for name in 'abcdef'),
+                       max_workers=2)
+        self.assertEqual(max(most), 2)
+
+
+class TestRunParallel(TestCase):
+
+    def test_results_in_order(self):
+        def square(n):
+            time.sleep(0.001 * (10 - n))
+            return n * n
+        self.assertEqual(util.run_parallel(square, range(10), 4),
+                         [n * n for n in range(10)])
+
+    def test_every_item_tried(self):
+        tried = []
+
+        def delete(n):
+            tried.append(n)
+            if n == 2:
+                raise KeyError(n)
+
+        with self.assertRaises(KeyError):
+            util.run_parallel(delete, range(5), max_workers=2)
+        self.assertEqual(sorted(tried), list(range(5)))
+
+    def test_no_limit(self):
+        # Like run_graph, 0 means no limit rather than no workers
+        for max_workers in (0, None):
+            self.assertEqual(
+                util.run_parallel(lambda n: n * n, range(5), max_workers),
+                [n * n for n in range(5)])
+
+
+class TestRateLimiter(TestCase):
+
+    def test_spaces_calls(self):
+        limiter = util.RateLimiter(100)
+        start = time.time()
+        for _ in range(5):
+            limiter.wait()
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+    def test_unlimited(self):
+        with mock.patch.object(util.time, 'sleep') as sleep:
+            limiter = util.RateLimiter(None)
+            for _ in range(5):
+                limiter.wait()
+        self.assertFalse(sleep.called)
+
+
+class TestCoalescer(TestCase):
+
+    def run_threads(self, coalescer, fn, count=5):
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(coalescer.call('key', fn))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_overlapping_calls_shared(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def wait():
+            started.set()
+            release.wait()
+            return 'result'
+
+        fn = mock.Mock(side_effect=wait)
+        coalescer = util.Coalescer()
+        leader = threading.Thread(
+            target=lambda: coalescer.call('key', fn))
+        leader.start()
+        started.wait()
+
+        def release_when_waiting():
+            while coalescer.shared < 5:
+                time.sleep(0.01)
+            release.set()
+
+        threading.Thread(target=release_when_waiting).start()
+        results, errors = self.run_threads(coalescer, fn)
+        leader.join()
+        self.assertEqual(fn.call_count, 1)
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(coalescer.shared, 5)
+
+    def test_exceptions_shared(self):
+        release = threading.Event()
+
+        def fn():
+            release.wait()
+            raise ValueError('failed')
+
+        coalescer = util.Coalescer()
+        threading.Timer(0.05, release.set).start()
+        results, errors = self.run_threads(coalescer, fn)
+        self.assertEqual(len(errors), 5)
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+        # Failures aren't remembered
+        self.assertEqual(coalescer.call('key', lambda: 'retried'), 'retried')
+
+    def test_ttl(self):
+        fn = mock.Mock(return_value='result')
+        coalescer = util.Coalescer(ttl=60)
+        coalescer.call('key', fn)
+        coalescer.call('key', fn)
+        coalescer.call('other', fn)
+        self.assertEqual(fn.call_count, 2)
+
+    def test_no_ttl(self):
+        fn = mock.Mock(return_value='result')
+        coalescer = util.Coalescer()
+        coalescer.call('key', fn)
+        coalescer.call('key', fn)
+        self.assertEqual(fn.call_count, 2)
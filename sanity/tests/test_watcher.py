@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import TestCase
+import time
+
+import mock
+
+from sanity import watcher
+
+
+def make_server(uuid, status, task_state=None, created=None, updated=None):
+    server = mock.Mock()
+    server.id = uuid
+    server.status = status
+    server.created = created
+    server.updated = updated
+    setattr(server, 'OS-EXT-STS:task_state', task_state)
+    return server
+
+
+class TestServerWatcher(TestCase):
+
+    def setUp(self):
+        self.servers = []
+        self.list_servers = mock.Mock(side_effect=lambda: self.servers)
+        self.watcher = watcher.ServerWatcher(self.list_servers)
+        # Drive the polling by hand instead of from the background thread
+        self.watcher._thread = mock.sentinel.thread
+
+    def test_settled_server(self):
+        self.servers = [make_server('1', 'BUILD')]
+        future = self.watcher.watch(make_server('1', 'BUILD'))
+        self.watcher.poll()
+        self.assertFalse(future.done())
+
+        self.servers = [make_server('1', 'ACTIVE', 'powering-on')]
+        self.watcher.poll()
+        self.assertFalse(future.done())
+
+        self.servers = [make_server('1', 'ACTIVE')]
+        self.watcher.poll()
+        self.assertEqual(future.result(0).status, 'ACTIVE')
+
+    def test_one_list_for_many_waiters(self):
+        self.servers = [make_server('1', 'ACTIVE'),
+                        make_server('2', 'ERROR')]
+        futures = [self.watcher.watch(make_server(uuid, 'BUILD'))
+                   for uuid in ['1', '2', '1']]
+        self.watcher.poll()
+        self.assertEqual(self.list_servers.call_count, 1)
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(self.watcher._futures, [])
+
+    def test_deleted_server(self):
+        server = make_server('1', 'ACTIVE')
+        future = self.watcher.watch(server)
+        self.watcher.poll()
+        self.assertEqual(future.result(0), server)
+
+    def test_timeout(self):
+        self.servers = [make_server('1', 'BUILD')]
+        future = self.watcher.watch(make_server('1', 'BUILD'), timeout=-1)
+        self.watcher.poll()
+        with self.assertRaises(watcher.ServerTimeout):
+            future.result(0)
+
+    def test_deadline_from_created(self):
+        # Nova's clock is an hour behind ours
+        nova_now = time.time() - 3600
+        created = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                time.gmtime(nova_now - 120))
+        fresh = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(nova_now))
+        self.servers = [make_server('1', 'BUILD', created=created,
+                                    updated=fresh),
+                        make_server('2', 'BUILD', created=fresh,
+                                    updated=fresh)]
+        old = self.watcher.watch(make_server('1', 'BUILD'), timeout=60)
+        new = self.watcher.watch(make_server('2', 'BUILD'), timeout=60)
+        self.watcher.poll()
+        with self.assertRaises(watcher.ServerTimeout):
+            old.result(0)
+        self.assertFalse(new.done())
+
+    def test_deadline_ignores_clock_skew(self):
+        # Nova's clock is an hour ahead of ours
+        created = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                time.gmtime(time.time() + 3600))
+        self.servers = [make_server('1', 'BUILD', created=created,
+                                    updated=created)]
+        future = self.watcher.watch(make_server('1', 'BUILD'), timeout=60)
+        self.watcher.poll()
+        self.assertFalse(future.done())
+        self.assertAlmostEqual(future.deadline, future.watched_at + 60)
+
+    def test_backoff(self):
+        self.watcher.max_interval = 3
+        self.servers = [make_server('1', 'BUILD')]
+        self.watcher.watch(make_server('1', 'BUILD'))
+        self.watcher.poll()
+        self.assertEqual(self.watcher.interval, 1)
+        for _ in range(5):
+            self.watcher.poll()
+        self.assertEqual(self.watcher.interval, 3)
+
+        self.servers = [make_server('1', 'BUILD', 'spawning')]
+        self.watcher.poll()
+        self.assertEqual(self.watcher.interval, 1)
+
+    def test_done_callback(self):
+        done = []
+        future = self.watcher.watch(make_server('1', 'ACTIVE'))
+        future.add_done_callback(done.append)
+        self.watcher.poll()
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
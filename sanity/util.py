@@ -14,8 +14,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import sys
+import threading
+import time
 from functools import wraps
 
+import six
+from six.moves import queue
+
 
 def listify(fn):
     def listify_return(fn):
@@ -24,3 +30,244 @@ def listify(fn):
             return list(fn(*args, **kw))
         return listify_helper
     return listify_return(fn)
+
+
+def background(fn, *args, **kwargs):
+    """Start calling a function in a background thread.
+
+    Returns a function that waits for the call to finish and returns its
+    result, re-raising any exception the call raised.
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = fn(*args, **kwargs)
+        except Exception:
+            outcome['error'] = sys.exc_info()
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+        thread.join()
+        if 'error' in outcome:
+            six.reraise(*outcome['error'])
+        return outcome['result']
+    return wait
+
+
+def run_graph(tasks, max_workers=None):
+    """Call functions concurrently, each once its dependencies are done.
+
+    tasks is {name: (fn, [dependency name, ...])}.  Each function is
+    called with no arguments in its own thread as soon as all the tasks
+    it depends on have returned, with at most max_workers running at
+    once.  Returns {name: result}.  If a task raises, no more tasks are
+    started and the first exception is re-raised once the running tasks
+    have finished.
+    """
+    for name, (fn, dependencies) in tasks.items():
+        for dependency in dependencies:
+            if dependency not in tasks:
+                raise ValueError("%s depends on unknown task %s"
+                                 % (name, dependency))
+    _check_acyclic(tasks)
+
+    results = {}
+    errors = []
+    started = set()
+    finished = set()
+    condition = threading.Condition()
+    workers = threading.Semaphore(max_workers or len(tasks) or 1)
+
+    def run(name, fn):
+        try:
+            with workers:
+                result = fn()
+        except Exception:
+            with condition:
+                errors.append(sys.exc_info())
+                finished.add(name)
+                condition.notify_all()
+        else:
+            with condition:
+                results[name] = result
+                finished.add(name)
+                condition.notify_all()
+
+    with condition:
+        while True:
+            if not errors:
+                for name, (fn, dependencies) in sorted(tasks.items()):
+                    if name in started:
+                        continue
+                    if not all(dependency in results
+                               for dependency in dependencies):
+                        continue
+                    started.add(name)
+                    thread = threading.Thread(target=run, args=(name, fn))
+                    thread.setName('%s-%s' % (
+                        threading.current_thread().getName(), name))
+                    thread.daemon = True
+                    thread.start()
+            if not started - finished:
+                break
+            condition.wait()
+
+    if errors:
+        six.reraise(*errors[0])
+    return results
+
+
+def run_parallel(fn, items, max_workers=10):
+    """Call fn on each item using at most max_workers threads.
+
+    As with run_graph, a max_workers of 0 or None means no limit.
+    Returns the results in the same order as the items.  Every item is
+    tried, and the first exception is re-raised once they all have been.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    todo = queue.Queue()
+    for index, item in enumerate(items):
+        todo.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = fn(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = []
+    for i in range(min(max_workers or len(items), len(items))):
+        thread = threading.Thread(target=worker)
+        thread.setName('%s-%s' % (threading.current_thread().getName(), i))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        six.reraise(*errors[0])
+    return results
+
+
+class RateLimiter(object):
+    """Space calls out so there are at most rate per second.
+
+    Shared between threads, each call to wait blocks until the caller's
+    turn.  A rate of None or 0 doesn't limit anything.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            turn = max(self._next, now)
+            self._next = turn + self.interval
+        if turn > now:
+            time.sleep(turn - now)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class Coalescer(object):
+    """Share the result of identical calls that overlap.
+
+    A call made while another with the same key is still running waits
+    for it and gets its result, or its exception, instead of running
+    again.  Results are also kept for ttl seconds after they finish, so
+    calls that arrive just after are answered without running either.
+    """
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self.calls = 0
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._recent = {}
+
+    def call(self, key, fn, *args, **kwargs):
+        with self._lock:
+            self.calls += 1
+            now = time.time()
+            if key in self._recent:
+                expires, result = self._recent[key]
+                if expires > now:
+                    self.shared += 1
+                    return result
+                del self._recent[key]
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                six.reraise(*call.exc_info)
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if self.ttl and call.exc_info is None:
+                    self._expire(time.time())
+                    self._recent[key] = (time.time() + self.ttl, call.result)
+            call.done.set()
+        return call.result
+
+    def _expire(self, now):
+        for key, (expires, result) in list(self._recent.items()):
+            if expires <= now:
+                del self._recent[key]
+
+    def __str__(self):
+        return "%s of %s calls shared" % (self.shared, self.calls)
+
+
+def _check_acyclic(tasks):
+    visiting = set()
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError("Task %s depends on itself" % name)
+        visiting.add(name)
+        for dependency in tasks[name][1]:
+            visit(dependency)
+        visiting.remove(name)
+        visited.add(name)
+
+    for name in tasks:
+        visit(name)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Cisco Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import calendar
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_timestamp(timestamp):
+    """Convert a Nova timestamp to seconds since the epoch."""
+    return calendar.timegm(
+        datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ").timetuple())
+
+
+def is_settled(server, states=('ACTIVE', 'ERROR')):
+    """Is the server in one of the states with no task in progress."""
+    if getattr(server, 'status', None) not in states:
+        return False
+    # A VM isn't in a stable state until its task has finished
+    if getattr(server, 'OS-EXT-STS:task_state', None):
+        return False
+    return True
+
+
+def mark_timed_out(server):
+    """Flag a server that didn't settle before its wait timed out."""
+    server.timed_out = True
+
+
+def has_timed_out(server):
+    """Has the server already been waited on until it timed out."""
+    return getattr(server, 'timed_out', False) is True
+
+
+class ServerTimeout(Exception):
+    """Servers didn't settle in time.
+
+    servers are the ones that timed out, as they were last listed, and
+    finished are the ones that settled.
+    """
+
+    def __init__(self, message, servers=(), finished=()):
+        super(ServerTimeout, self).__init__(message)
+        self.servers = list(servers)
+        self.finished = list(finished)
+
+
+class ServerFuture(object):
+    """The eventual stable state of a single server.
+
+    The future times out on its own deadline.  Servers that are still
+    building are given until timeout seconds after they were created,
+    for anything else the clock starts when the server is watched.  The
+    most recently listed version of the server is kept in latest.
+
+    Nova's clock may not agree with ours, so a building server's age is
+    taken from the difference between its Nova timestamps and counted
+    back from the local time it was watched at.
+    """
+
+    def __init__(self, server, states, timeout):
+        self.server = server
+        self.server_id = server.id
+        self.states = states
+        self.timeout = timeout
+        self.watched_at = time.time()
+        self.deadline = self.watched_at + timeout
+        self.latest = server
+        self._deadline_from_created = False
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        self._event.wait(timeout)
+        if not self._event.is_set():
+            raise ServerTimeout("Timed out waiting for server %s."
+                                % self.server_id)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, result, exception):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                LOG.exception("Server future callback failed")
+
+    def set_result(self, server):
+        self._set(server, None)
+
+    def set_exception(self, exception):
+        self._set(None, exception)
+
+    def update(self, server, now):
+        """Resolve the future from a freshly listed server.
+
+        Servers that have disappeared (server is None) have been deleted.
+        """
+        if server is None:
+            self.set_result(self.server)
+            return
+        self.latest = server
+        if self.is_settled(server):
+            self.set_result(server)
+        else:
+            if (not self._deadline_from_created and
+                    server.status == 'BUILD' and
+                    getattr(server, 'created', None)):
+                self.deadline = (self.watched_at - self.build_age(server) +
+                                 self.timeout)
+                self._deadline_from_created = True
+            self.check_deadline(now)
+
+    @staticmethod
+    def build_age(server):
+        """Seconds the server had been building for when Nova updated it."""
+        updated = getattr(server, 'updated', None)
+        if not updated:
+            return 0
+        return max(parse_timestamp(updated) -
+                   parse_timestamp(server.created), 0)
+
+    def check_deadline(self, now):
+        if now > self.deadline:
+            self.set_exception(ServerTimeout(
+                "Timed out waiting for server %s." % self.server_id))
+
+    def is_settled(self, server):
+        return is_settled(server, self.states)
+
+
+class ServerWatcher(object):
+    """Poll the server list on behalf of every waiting thread.
+
+    Threads register the servers they are interested in with
+    :meth:`watch` and block on the returned future.  A single background
+    thread lists the servers and resolves the futures as their servers
+    settle, so the number of list calls doesn't grow with the number of
+    waiting threads.
+
+    Polling starts at min_interval and backs off towards max_interval
+    while none of the watched servers change, with some random jitter so
+    that several sanity runs don't poll in lock step.  Watching a new
+    server or seeing a change resets the interval.
+    """
+
+    backoff = 1.5
+    jitter = 0.2
+
+    def __init__(self, list_servers, min_interval=1, max_interval=10):
+        self._list_servers = list_servers
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._futures = []
+        self._last_seen = {}
+        self._thread = None
+
+    def watch(self, server, states=('ACTIVE', 'ERROR'), timeout=60):
+        future = ServerFuture(server, states, timeout)
+        with self._lock:
+            self._futures.append(future)
+            self.interval = self.min_interval
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setName('ServerWatcher')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+        return future
+
+    def poll(self):
+        """List the servers once and resolve any futures that are done.
+
+        Returns True if any of the watched servers changed.
+        """
+        with self._lock:
+            futures = list(self._futures)
+        if not futures:
+            return False
+
+        try:
+            servers = dict((server.id, server)
+                           for server in self._list_servers())
+        except Exception:
+            LOG.exception("Failed to list servers")
+            servers = None
+
+        now = time.time()
+        changed = False
+        for future in futures:
+            if servers is None:
+                future.check_deadline(now)
+                continue
+            server = servers.get(future.server_id)
+            if server is not None:
+                seen = (server.status,
+                        getattr(server, 'OS-EXT-STS:task_state', None))
+                if self._last_seen.get(future.server_id) != seen:
+                    self._last_seen[future.server_id] = seen
+                    changed = True
+            future.update(server, now)
+            if future.done():
+                changed = True
+
+        with self._lock:
+            self._futures = [future for future in self._futures
+                             if not future.done()]
+            watched = set(future.server_id for future in self._futures)
+            for server_id in list(self._last_seen):
+                if server_id not in watched:
+                    del self._last_seen[server_id]
+            if changed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff,
+                                    self.max_interval)
+        return changed
+
+    def next_poll_in(self):
+        """The number of seconds to wait before the next poll."""
+        with self._lock:
+            delay = self.interval * random.uniform(1 - self.jitter,
+                                                   1 + self.jitter)
+            # Wake up in time to expire the next future that times out
+            if self._futures:
+                deadline = min(future.deadline for future in self._futures)
+                delay = min(delay, max(deadline - time.time(), 0) + 0.1)
+        return delay
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._futures:
+                    self._thread = None
+                    return
+            started = time.time()
+            self._wakeup.clear()
+            self.poll()
+            self._wakeup.wait(self.next_poll_in())
+            # Newly watched servers wake us up early, but never poll more
+            # often than the minimum interval.
+            remaining = self.min_interval - (time.time() - started)
+            if remaining > 0:
+                time.sleep(remaining)